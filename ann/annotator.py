@@ -1,5 +1,7 @@
 import subprocess
 import os
+import time
+import threading
 import boto3, botocore
 import json
 
@@ -12,13 +14,69 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'ann_config
 sqs = boto3.resource('sqs', region_name=config['aws']['AwsRegionName'])
 queue = sqs.get_queue_by_name(QueueName=config['aws']['AwsSqsRequestQueueName'])
 
+# with checkpoints, job messages are deleted only once the job exits
+checkpoint = config.getint('anntools', 'CheckpointInterval') > 0
+visibility_timeout = config.getint('anntools', 'CheckpointVisibilityTimeout')
+running = []
+
+# messages kept in flight, from their receipt (the input download and the
+# job launch can take longer than the timeout) until their job exits
+in_flight = set()
+in_flight_lock = threading.Lock()
+
+
+# extends the visibility of the messages in flight every third of the
+# timeout, on a thread of its own so that no blocking step of the receive
+# loop delays it; boto3 resources are not thread safe, so it uses a client
+def extend_visibility():
+    client = boto3.client('sqs', region_name=config['aws']['AwsRegionName'])
+    while True:
+        time.sleep(visibility_timeout / 3)
+        with in_flight_lock:
+            messages = list(in_flight)
+        for (queue_url, receipt_handle) in messages:
+            try:
+                client.change_message_visibility(QueueUrl=queue_url,
+                    ReceiptHandle=receipt_handle,
+                    VisibilityTimeout=visibility_timeout)
+            except botocore.exceptions.ClientError as e:
+                print(e)
+
+
+def release(m):
+    with in_flight_lock:
+        in_flight.discard((m.queue_url, m.receipt_handle))
+
+
+if checkpoint:
+    threading.Thread(target=extend_visibility, daemon=True).start()
+
 while True:
+    # delete the messages of the jobs that exited; a job lost with its
+    # instance is redelivered and resumes from its checkpoint
+    for (process, m) in list(running):
+        try:
+            if process.poll() is not None:
+                release(m)
+                m.delete()
+                running.remove((process, m))
+        except botocore.exceptions.ClientError as e:
+            print(e)
+
     try:
         messages = queue.receive_messages(WaitTimeSeconds=20)
     except botocore.exceptions.ClientError as e:
         print(e)
 
     for m in messages:
+        if checkpoint:
+            try:
+                m.change_visibility(VisibilityTimeout=visibility_timeout)
+            except botocore.exceptions.ClientError as e:
+                print(e)
+            with in_flight_lock:
+                in_flight.add((m.queue_url, m.receipt_handle))
+
         try:
             request_dict = json.loads(json.loads(m.body)['Message'])
         except Exception:
@@ -43,9 +101,12 @@ while True:
 
         # download input file
         unique_filename = f'{job_id}~{input_file_name}'
+        # (streamed inputs are read from S3 by the annotation job itself)
+        stream_input = config.getboolean('anntools', 'StreamInput')
         s3 = boto3.resource('s3', region_name = config['aws']['AwsRegionName'])
         try:
-            s3.Bucket(s3_bucket).download_file(s3_file_key, unique_filename)
+            if not stream_input:
+                s3.Bucket(s3_bucket).download_file(s3_file_key, unique_filename)
         except botocore.exceptions.ClientError as e:
             print(f'Cannot obtain the file just uploaded. {e}')
 
@@ -59,6 +120,9 @@ while True:
 
         # Launch annotation job as a background process
         launch_cmd = f'python /home/ubuntu/gas/ann/anntools/run.py /home/ubuntu/gas/ann/jobs/{unique_filename} {job_id} {user_id}'
+        if stream_input:
+            launch_cmd = f'{launch_cmd} s3://{s3_bucket}/{s3_file_key}'
+        process = None
         try:
             process = subprocess.Popen(launch_cmd, shell=True, stdout=f)
         except Exception as e:
@@ -84,6 +148,11 @@ while True:
             print(f'Job status update error. {e}')
 
 
+        if checkpoint and (process is not None):
+            running.append((process, m))
+            continue
+
+        release(m)
         try:
             # delete current message from sqs only after successful update to DB
             m.delete()
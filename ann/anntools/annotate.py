@@ -15,41 +15,45 @@ import utils as u
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
+# Columns of the gene tables and of bigRefSeqTable, with the '=' the
+# collapsed fields are prefixed with built once rather than on every call
+GENE_COLUMNS = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart',
+    'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds',
+    'score', 'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
+GENE_PREFIXES = [name + '=' for name in GENE_COLUMNS]
+REFSEQ_COLUMNS = ['chr', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+REFSEQ_PREFIXES = [name + '=' for name in REFSEQ_COLUMNS]
+
+# Characters removed by clean_mysql_chars
+MYSQL_CHARS = str.maketrans('', '', '"\'')
+
+COMPLEMENTARY = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+
 def collapseGeneNames(row, indices, region, cnt):
-    names = ['bin', 'name', 'chrom', 'transcriptStrand', 'txStart', 'txEnd', 
-        'cdsStart', 'cdsEnd', 'exonCount', 'exonStarts', 'exonEnds', 'score',
-        'name2', 'cdsStartStat', 'cdsEndStat', 'exonFrames']
-    collapsed=[]
+    collapsed = []
     for i in indices:
-        mn = names[i]
         r = str(row[i])
-        if(len(r) > 0 ):
-            collapsed.append(mn + '=' + r.strip())
+        if (len(r) > 0):
+            collapsed.append(GENE_PREFIXES[i] + r.strip())
     collapsed.append(region)
 
     return  ';'.join(collapsed)
 
 
 """"Collapces bigRefSegTable
+    Skips the coordinates and alleles (the first 5 fields), empty fields
+    and fields that are '0'
 """
 def collapseRefSeq(line):
-    names = ['chr', 'start', 'end', 'haplotypeReference', 
-        'haplotypeAlternate', 'name', 'name2', 'transcriptStrand', 
-        'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
-        'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
-        'changesAA', 'functionalClass','codingCoordStr','proteinCoordStr',
-        'inCodingRegion', 'spliceInfo','uorfChange']
     fields = line.strip().split('\t')
-    fcount = 0
-    collapsed = []
-
-    for f in fields:
-        if (fcount > 4):
-            if(len(str(f)) > 0 and str(f) !='0'):
-                collapsed.append(str(names[fcount]).strip() + '=' + str(f).strip())
-        fcount = fcount + 1
-
-    return  ';'.join(collapsed)
+    return ';'.join([REFSEQ_PREFIXES[i] + f.strip()
+        for (i, f) in enumerate(fields[5:], 5) if f and (f != '0')])
 
 
 def binarySearchUniqueAndSorted(arg0, key):
@@ -73,11 +77,23 @@ def binarySearchUniqueAndSorted(arg0, key):
 
 
 """Cleans characters not accepted by MySQL
+   Most entries have none, and testing for them is cheaper than deleting
 """
 def clean_mysql_chars(entry):
-    entry = entry.replace("\"", "")
-    entry = entry.replace("\'", "")
-    return str(entry)
+    if ('"' in entry) or ("'" in entry):
+        return entry.translate(MYSQL_CHARS)
+    return entry
+
+
+"""Splits a line into the columns up to INFO, and the rest of the line:
+   FORMAT and the genotype columns, which are only written back, in one
+   tab separated string
+"""
+def splitLine(line, sep='\t'):
+    fields = line.split(sep, 8)
+    if (len(fields) > 8) and (sep != '\t'):
+        fields[8] = fields[8].replace(sep, '\t')
+    return fields
 
 
 def getFormatSpecificIndices(format='vcf'):
@@ -93,18 +109,10 @@ def getFormatSpecificIndices(format='vcf'):
     return [chr_ind, pos_ind, ref_ind, alt_ind]
 
 
+"""Complementary base of a single nucleotide, '' for anything else
+"""
 def getComplementary(nuc):
-    compNuc = ''
-    if (str(nuc) == 'A'):
-        return 'T'
-    elif (str(nuc) == 'T'):
-        return 'A'
-    elif (str(nuc) == 'G'):
-        return 'C'
-    elif (str(nuc) == 'C'):
-        return 'G'
-    else:
-        return compNuc
+    return COMPLEMENTARY.get(nuc, '')
 
 
 """"Format must be pileup or vcf
@@ -122,14 +130,14 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     inds = getFormatSpecificIndices(format=format)
 
     fh = open(vcf)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            fields = splitLine(line, sep)
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace('chr', '')
@@ -187,7 +195,6 @@ def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
     fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -205,14 +212,14 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
 
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     vcf_linenum = 1
 
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            fields = splitLine(line, sep)
             chr = fields[inds[0]].strip()
             if chr.startswith("chr"):
                 chr = chr.replace('chr', '')
@@ -297,7 +304,6 @@ def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
         else:
             fh_out.write(line + '\n')
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -327,14 +333,14 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            fields = splitLine(line, sep)
             chr = fields[inds[0]].strip()
 
             if not chr.startswith("chr"):
@@ -349,7 +355,7 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
                 '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+                str(promoter_offset) +') order by txStart, txEnd, name;'
 
             cursor.execute(sql)
             rows = cursor.fetchall()
@@ -420,7 +426,8 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                         sql = 'select chrom, chromStart, chromEnd, name from ' + \
                             'cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                            ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                            'order by chromStart, chromEnd, name;'
                         cursor.execute(sql)
                         rows = cursor.fetchone()
 
@@ -433,7 +440,8 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
                         sql = 'select chrom, chromStart, chromEnd, name from ' + \
                             'cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
+                            ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                            'order by chromStart, chromEnd, name;'
                         cursor.execute(sql)
 
                         rows = cursor.fetchone()
@@ -498,7 +506,6 @@ def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
@@ -526,14 +533,14 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
 
     inds = getFormatSpecificIndices(format=format)
     fh = open(vcf)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
     for line in fh:
         line = line.strip()
         if not line.startswith("#"):
-            fields = line.split(sep)
+            fields = splitLine(line, sep)
             chr = fields[inds[0]].strip()
             
             if not chr.startswith("chr"):
@@ -548,7 +555,7 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
             sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
                 '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
                 str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
+                str(promoter_offset) +') order by txStart, txEnd, name;'
             cursor.execute(sql)
             rows = cursor.fetchall()
             info = []
@@ -629,7 +636,8 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         sql = 'select chrom, chromStart, chromEnd, name ' + \
                             'from cpgIslandExt where chrom="' + str(chr) +  \
                             '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
+                            str(pos) + ' <= chromEnd) ' + \
+                            'order by chromStart, chromEnd, name;'
                         cursor.execute(sql)
                         rows = cursor.fetchone()
 
@@ -643,7 +651,8 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
                         sql = 'select chrom, chromStart, chromEnd, name ' + \
                             'from cpgIslandExt where chrom="' + str(chr) + \
                             '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
+                            str(pos) + ' <= chromEnd) ' + \
+                            'order by chromStart, chromEnd, name;'
                         cursor.execute(sql)
                         rows = cursor.fetchone()
 
@@ -709,7 +718,6 @@ def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500,
     fh_out.close()
     fh_log.close()
     fh.close()
-    conn.close()
 
 
 """Overlap with tfbsConsSites
@@ -733,7 +741,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
 
     linenum = 1
@@ -748,7 +756,7 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
             fh_out.write(line + '\n')
 
         else:
-            fields = line.split(sep)
+            fields = splitLine(line, sep)
             chr = fields[inds[0]].strip()
             # For some reason this table has no "chr" preceeding number
             if not chr.startswith("chr"):
@@ -763,7 +771,8 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
                 sql = 'select chrom, chromStart, chromEnd, name ' + \
                     'from tfbsConsSites' + chrIndex + \
                     ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
+                    str(pos) + ' <= chromEnd ' + \
+                    'order by chromStart, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchall()
                 records = []
@@ -799,7 +808,6 @@ def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -822,7 +830,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -834,7 +842,7 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 # For some reason this table has no "chr" preceeding number
                 if chr.startswith("chr"):
@@ -845,7 +853,8 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
 
                 sql = 'select * from ' + table + ' where chromosome="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
+                    ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                    'order by chromStart, chromEnd, geneSymbol;'
                 cursor.execute(sql)
                 rows = cursor.fetchall()
                 records = []
@@ -864,6 +873,8 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
                         fields[7] = fields[7] + ';'.join(records)
                     else:
                         fields[7] = fields[7] + ';' + ';'.join(records)
+                    if (len(fields) > 8):
+                        fields[8] = fields[8].replace('\t', '\t ')
                     fh_out.write('\t '.join(fields) + '\n')
                 else:
                     fh_out.write(line + '\n')
@@ -876,7 +887,6 @@ def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -898,7 +908,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -910,7 +920,7 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -919,7 +929,8 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
                 isOverlap = False
 
                 sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
+                    str(chr) + '" AND chromEnd = ' + str(pos) + \
+                    ' order by chromEnd, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchall()
                 records = []
@@ -948,7 +959,6 @@ def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -971,7 +981,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -983,7 +993,7 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -993,7 +1003,8 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
 
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
+                    ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                    'order by chromStart, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchall()
                 records = []
@@ -1028,7 +1039,6 @@ def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -1051,7 +1061,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1063,7 +1073,7 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -1077,7 +1087,8 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
 
                 sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
                     '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
+                    ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                    'order by chromStart, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchone()
 
@@ -1103,7 +1114,6 @@ def addOverlapWithGenomicSuperDups(vcf, format='vcf',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -1132,7 +1142,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     endName = 'txEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1144,7 +1154,7 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -1182,7 +1192,6 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -1212,7 +1221,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         endName = 'chromEnd'
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1224,7 +1233,7 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -1234,7 +1243,8 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
                 
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
+                    ' AND ' + str(pos) + ' <= ' + endName + ') order by ' + \
+                    startName + ', ' + endName + ', name;'
                 overlapsWith = []
                 cursor.execute(sql)
                 rows = cursor.fetchall()
@@ -1261,7 +1271,6 @@ def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -1284,7 +1293,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1296,7 +1305,7 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -1305,7 +1314,8 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
                 isOverlap = False
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
+                    ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                    'order by chromStart, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchone()
 
@@ -1329,7 +1339,6 @@ def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -1352,7 +1361,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
     line_count = 0
 
     inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
+    conn = u.get_db_connection()
     cursor = conn.cursor()
     linenum = 1
 
@@ -1364,7 +1373,7 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
             if (line.startswith('CHROM') or line.startswith('#CHROM')):
                 fh_out.write(line + '\n')
             else:
-                fields = line.split(sep)
+                fields = splitLine(line, sep)
                 chr = fields[inds[0]].strip()
                 if not chr.startswith("chr"):
                     chr = "chr" + chr
@@ -1372,7 +1381,8 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
                 pos = fields[inds[1]].strip()
                 sql = 'select * from ' + table + ' where chrom="' + \
                     str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
+                    ' AND ' + str(pos) + ' <= chromEnd) ' + \
+                    'order by chromStart, chromEnd, name;'
                 cursor.execute(sql)
                 rows = cursor.fetchone()
 
@@ -1396,7 +1406,6 @@ def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS',
         f"{str(line_count)} variants\n")
     fh_log.close()
 
-    conn.close()
     fh.close()
     fh_out.close()
 
@@ -0,0 +1,350 @@
+# benchmark.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# End-to-end benchmarks for AnnTools
+#
+# Generates synthetic VCF files of a given size and chromosome distribution
+# and runs the pipeline on them against an SQLite stand-in of the reference
+# database (see localdb.py): once with every stage, then once per stage.
+# Each run is made in a fresh process so its peak RSS is its own, and the
+# fastest of REPEATS runs is kept. Reports variants/sec, queries/sec and
+# peak RSS, and appends the results, tagged with the git commit, to a
+# results file so runs of different commits can be compared.
+#
+# The micro command times the helpers called on every line of every stage
+# and fails if any of them is slower than its fixed budget.
+#
+# Usage:
+#   python benchmark.py vcf <vcf> <variants> [chrom=weight,...] [samples]
+#   python benchmark.py run <db_file> <vcf> [results_file] [option=value ...]
+#   python benchmark.py compare <results_file>
+#   python benchmark.py micro
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import resource
+import timeit
+import tempfile
+import subprocess
+import multiprocessing
+
+# Seed of the generated VCF files
+SEED = 11
+# Default results file, in the working directory
+RESULTS_FILE = 'benchmark_results.jsonl'
+# Runs of each measurement; the fastest one is reported
+REPEATS = 3
+# Throughput drops larger than this fraction are reported as regressions
+REGRESSION_THRESHOLD = 0.1
+
+# Chromosome lengths (GRCh37), the default distribution of the variants
+CHROM_LENGTHS = [('1', 249250621), ('2', 243199373), ('3', 198022430),
+    ('4', 191154276), ('5', 180915260), ('6', 171115067), ('7', 159138663),
+    ('8', 146364022), ('9', 141213431), ('10', 135534747),
+    ('11', 135006516), ('12', 133851895), ('13', 115169878),
+    ('14', 107349540), ('15', 102531392), ('16', 90354753),
+    ('17', 81195210), ('18', 78077248), ('19', 59128983), ('20', 63025520),
+    ('21', 48129895), ('22', 51304566), ('X', 155270560), ('Y', 59373566),
+    ('MT', 16569)]
+BASES = 'ACGT'
+
+
+"""Parses a chrom=weight,... distribution, e.g. '1=2,X=1'
+"""
+def parseWeights(spec):
+    weights = []
+    for item in spec.split(','):
+        (chrom, _, weight) = item.partition('=')
+        weights.append((chrom.strip(), float(weight or 1)))
+    return weights
+
+
+"""Writes a coordinate-sorted VCF of variants random records, placed on
+   the chromosomes in proportion to weights (their lengths by default)
+"""
+def generateVcf(path, variants, weights=None, samples=2, seed=SEED):
+    rnd = random.Random(seed)
+    if weights is None:
+        weights = CHROM_LENGTHS
+    lengths = dict(CHROM_LENGTHS)
+    chroms = [chrom for (chrom, weight) in weights]
+    order = dict((chrom, n) for (n, chrom) in enumerate(chroms))
+
+    records = []
+    for chrom in rnd.choices(chroms, weights=[w for (c, w) in weights],
+        k=variants):
+        records.append((chrom, rnd.randint(1, lengths.get(chrom, 100000000))))
+    records.sort(key=lambda r: (order[r[0]], r[1]))
+
+    fh = open(path, 'w')
+    fh.write('##fileformat=VCFv4.1\n' + \
+        '##INFO=<ID=AC,Number=.,Type=Integer,Description="Allele count in genotypes">\n' + \
+        '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">\n' + \
+        '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total depth">\n' + \
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    fh.write('\t'.join(['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
+        'INFO'] + (['FORMAT'] + ['SAMPLE' + str(n + 1)
+        for n in range(samples)] if samples > 0 else [])) + '\n')
+
+    for (chrom, pos) in records:
+        ref = rnd.choice(BASES)
+        alt = rnd.choice(BASES.replace(ref, ''))
+        if (rnd.random() < 0.1):
+            # Insertions and deletions of up to 3 bases
+            indel = ''.join([rnd.choice(BASES) for i in range(rnd.randint(1, 3))])
+            (ref, alt) = rnd.choice([(ref + indel, ref), (ref, ref + indel)])
+        genotypes = [rnd.choice(['0/0', '0/1', '1/1']) for n in range(samples)]
+        ac = sum([g.count('1') for g in genotypes])
+        fields = [chrom, str(pos), '.', ref, alt, '.', '.',
+            f"AC={ac};AN={2 * samples};DP={rnd.randint(10, 500)}"]
+        if (samples > 0):
+            fields = fields + ['GT'] + genotypes
+        fh.write('\t'.join(fields) + '\n')
+    fh.close()
+
+
+def countVariants(vcf):
+    import bgzf
+
+    fh = bgzf.openText(vcf)
+    n = sum([1 for line in fh if not line.startswith('#')])
+    fh.close()
+    return n
+
+
+"""Annotates a copy of vcf against the stand-in db, with all stages or
+   only the one at stage_index. Runs in a fresh process; returns the wall
+   time, the metrics of the run and the peak RSS of the process
+"""
+def runPipeline(db, vcf, stage_index, options):
+    os.environ['ANNTOOLS_SQLITE_DB'] = db
+    import engine
+    import stages as st
+    import metrics as mt
+    import bundle as bn
+
+    workdir = tempfile.mkdtemp(prefix='anntools_bench_')
+    infile = os.path.join(workdir, os.path.basename(vcf))
+    shutil.copy(vcf, infile)
+    stages = None
+    if stage_index is not None:
+        bundle = None
+        if options.get('bundle'):
+            bundle = bn.Bundle(options['bundle'],
+                version=options.get('bundle_version'))
+        stages = [st.defaultStages(format='vcf',
+            join=options.get('join', False),
+            sweep=options.get('sweep', False), bundle=bundle,
+            bins=options.get('bins', False))[stage_index]]
+
+    metrics = mt.Metrics()
+    start = time.time()
+    stages = engine.run(infile, format='vcf', stages=stages, metrics=metrics,
+        **options)
+    wall_time = time.time() - start
+    shutil.rmtree(workdir)
+
+    # ru_maxrss is in KB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return ([stage.name for stage in stages], wall_time,
+        metrics.getSummary(), peak_rss)
+
+
+"""runPipeline in a new process, repeats times; returns the fastest run
+"""
+def runIsolated(db, vcf, stage_index, options, repeats=REPEATS):
+    ctx = multiprocessing.get_context('spawn')
+    best = None
+    for n in range(repeats):
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            result = pool.apply(runPipeline, (db, vcf, stage_index, options))
+        if (best is None) or (result[1] < best[1]):
+            best = result
+    return best
+
+
+def getResult(name, variants, wall_time, summary, peak_rss):
+    queries = sum([s['queries'] for s in summary['stages'].values()])
+    return {'stage': name, 'time': round(wall_time, 3),
+        'variants_per_sec': round(variants / wall_time, 1) \
+            if (wall_time > 0) else 0.0,
+        'queries': queries,
+        'queries_per_sec': round(queries / wall_time, 1) \
+            if (wall_time > 0) else 0.0,
+        'peak_rss_mb': round(peak_rss, 1)}
+
+
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+"""Benchmarks the whole pipeline and every stage on vcf and appends the
+   results to results_file. options are passed on to engine.run
+"""
+def run(db, vcf, results_file=RESULTS_FILE, options={}, repeats=REPEATS):
+    variants = countVariants(vcf)
+    (names, wall_time, summary, peak_rss) = runIsolated(db, vcf, None,
+        options, repeats)
+    results = [getResult('pipeline', variants, wall_time, summary, peak_rss)]
+
+    for (n, name) in enumerate(names):
+        (stage_names, wall_time, summary, peak_rss) = runIsolated(db, vcf, n,
+            options, repeats)
+        results.append(getResult(name, variants, wall_time, summary,
+            peak_rss))
+
+    record = {'commit': getCommit(), 'created': int(time.time()),
+        'host': platform.node(), 'python': platform.python_version(),
+        'vcf': os.path.basename(vcf), 'variants': variants,
+        'options': options, 'repeats': repeats, 'results': results}
+    with open(results_file, 'a') as fh:
+        fh.write(json.dumps(record) + '\n')
+
+    print(f"{variants} variants, commit {record['commit'] or 'unknown'}")
+    print(f"{'stage':<34}{'time':>10}{'variants/s':>14}{'queries':>10}" + \
+        f"{'queries/s':>12}{'RSS MB':>10}")
+    for r in results:
+        print(f"{r['stage']:<34}{r['time']:>10.2f}" + \
+            f"{r['variants_per_sec']:>14.1f}{r['queries']:>10}" + \
+            f"{r['queries_per_sec']:>12.1f}{r['peak_rss_mb']:>10.1f}")
+    return record
+
+
+"""Compares the last run in results_file with the previous run on the same
+   VCF with the same options. Returns False if a stage got slower by more
+   than REGRESSION_THRESHOLD
+"""
+def compare(results_file=RESULTS_FILE):
+    with open(results_file) as fh:
+        records = [json.loads(line) for line in fh if line.strip()]
+    if (len(records) == 0):
+        print(f"No results in {results_file}")
+        return True
+    last = records[-1]
+    previous = [r for r in records[:-1] if (r['vcf'] == last['vcf']) and
+        (r['options'] == last['options'])]
+    if (len(previous) == 0):
+        print(f"No earlier run of {last['vcf']} to compare with")
+        return True
+    previous = previous[-1]
+
+    ok = True
+    before = dict((r['stage'], r) for r in previous['results'])
+    print(f"{previous['commit'] or 'unknown'} -> {last['commit'] or 'unknown'}" + \
+        f" ({last['vcf']}, {last['variants']} variants)")
+    for r in last['results']:
+        b = before.get(r['stage'])
+        if (b is None) or (b['variants_per_sec'] == 0):
+            continue
+        change = r['variants_per_sec'] / b['variants_per_sec'] - 1
+        flag = ''
+        if (change < -REGRESSION_THRESHOLD):
+            flag = '  REGRESSION'
+            ok = False
+        print(f"{r['stage']:<34}{b['variants_per_sec']:>12.1f} ->" + \
+            f"{r['variants_per_sec']:>12.1f} variants/s " + \
+            f"({100 * change:+.1f}%){flag}")
+    return ok
+
+
+# Calls per timing of a helper, and timings (the fastest is kept)
+MICRO_NUMBER = 100000
+MICRO_REPEATS = 5
+
+# Typical arguments of the helpers: a bigRefSeqTable row, a refGene row
+# and the INFO field of a variant annotated with it
+REFSEQ_LINE = '1\t1000\t1001\tA\tG\tNM_000001\tGENE1\t+\tintron\t0\t123\t41' + \
+    '\t-5\tATG\tM\tGTG\tV\t1\tmissense\tc.123A>G\tp.M41V\t1\t0\t'
+GENE_ROW = [585, 'NM_000001', 'chr1', '+', 1000, 2000, 1100, 1900, 3,
+    '1000,', '2000,', 0, 'GENE1', 'cmpl', 'cmpl', '0,']
+INFO_FIELD = 'name=NM_000001;name2=GENE1;transcriptStrand=+;' + \
+    'positionType=intron;frame=0'
+
+
+"""Hot-path helpers as (name, function, arguments, budget), the budget in
+   nanoseconds per call, about twice their time when the budgets were set
+"""
+def getMicroCases():
+    import annotate as ann
+    import utils as u
+
+    return [('collapseRefSeq', ann.collapseRefSeq, (REFSEQ_LINE,), 8000),
+        ('collapseGeneNames', ann.collapseGeneNames,
+            (GENE_ROW, ann.indicesKnownGenes, 'exon', 0), 2000),
+        ('clean_mysql_chars', ann.clean_mysql_chars, ('ACGT',), 400),
+        ('clean_mysql_chars quoted', ann.clean_mysql_chars, ('AC"G\'T',),
+            1200),
+        ('getComplementary', ann.getComplementary, ('G',), 300),
+        ('parse_field', u.parse_field,
+            (INFO_FIELD, 'positionType', ';', '='), 2500)]
+
+
+"""Times the hot-path helpers. Returns False if one is over its budget
+"""
+def micro(number=MICRO_NUMBER, repeats=MICRO_REPEATS):
+    ok = True
+    for (name, function, args, budget) in getMicroCases():
+        seconds = min(timeit.repeat(lambda: function(*args), number=number,
+            repeat=repeats))
+        ns = 1e9 * seconds / number
+        flag = ''
+        if (ns > budget):
+            flag = '  REGRESSION'
+            ok = False
+        print(f"{name:<34}{ns:>10.0f} ns/call  (budget {budget}){flag}")
+    return ok
+
+
+"""Parses option=value arguments, values in JSON (true, 4...) or strings
+"""
+def parseOptions(args):
+    options = {}
+    for arg in args:
+        (name, _, value) = arg.partition('=')
+        try:
+            options[name] = json.loads(value)
+        except ValueError:
+            options[name] = value
+    return options
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 3 and sys.argv[1] == 'vcf'):
+        generateVcf(sys.argv[2], int(sys.argv[3]),
+            weights=parseWeights(sys.argv[4]) if len(sys.argv) > 4 else None,
+            samples=int(sys.argv[5]) if len(sys.argv) > 5 else 2)
+    elif (len(sys.argv) > 3 and sys.argv[1] == 'run'):
+        args = sys.argv[4:]
+        results_file = RESULTS_FILE
+        if (len(args) > 0) and ('=' not in args[0]):
+            results_file = args.pop(0)
+        run(sys.argv[2], sys.argv[3], results_file, parseOptions(args))
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'compare'):
+        sys.exit(0 if compare(sys.argv[2] if len(sys.argv) > 2
+            else RESULTS_FILE) else 1)
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'micro'):
+        sys.exit(0 if micro() else 1)
+    else:
+        print("Usage: python benchmark.py vcf <vcf> <variants> " + \
+            "[chrom=weight,...] [samples]\n" + \
+            "       python benchmark.py run <db_file> <vcf> [results_file] " + \
+            "[option=value ...]\n" + \
+            "       python benchmark.py compare [results_file]\n" + \
+            "       python benchmark.py micro")
+
+### EOF
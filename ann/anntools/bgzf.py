@@ -0,0 +1,254 @@
+# bgzf.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compressed VCF input and output for AnnTools
+#
+# Inputs compressed with gzip or bgzip (BGZF is a series of gzip members)
+# are decompressed while they are read. The annotated output can be
+# written as BGZF, i.e. independently compressed blocks of at most 64 KB,
+# with a tabix index (.tbi) of the record coordinates built in the same
+# pass, so tabix, bcftools or any BGZF reader can seek to a region.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import gzip
+import zlib
+import struct
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Uncompressed bytes per BGZF block (as in htslib)
+BLOCK_SIZE = 0xff00
+# Empty block marking the end of a BGZF file
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+# Tabix index layout: 16 kb linear index windows, 5 levels of bins
+TBI_MIN_SHIFT = 14
+TBI_DEPTH = 5
+TBI_FORMAT_VCF = 2
+
+
+"""True if the file starts with the gzip magic bytes
+"""
+def isGzip(path):
+    with open(path, 'rb') as fh:
+        return (fh.read(2) == GZIP_MAGIC)
+
+
+"""Text stream over a binary stream, decompressed if it is gzip or BGZF
+"""
+def openTextStream(fh):
+    if not isinstance(fh, io.BufferedReader):
+        fh = io.BufferedReader(fh)
+    if (fh.peek(2)[:2] == GZIP_MAGIC):
+        fh = gzip.GzipFile(fileobj=fh, mode='rb')
+    return io.TextIOWrapper(fh)
+
+
+"""Opens a plain, gzip or BGZF file for reading text
+"""
+def openText(path):
+    return openTextStream(open(path, 'rb'))
+
+
+"""Name of a file with its .gz extension removed
+"""
+def stripGz(path):
+    return path[:-len('.gz')] if path.endswith('.gz') else path
+
+
+"""BGZF writer over a binary file
+   tell() returns the virtual offset of the next byte written: the file
+   offset of its block shifted left by 16 bits, plus its offset within
+   the uncompressed block. copy (e.g. an s3stream.S3Upload) gets the
+   compressed blocks too.
+"""
+class BgzfFile(object):
+
+    def __init__(self, fh, copy=None, level=6):
+        self.fh = fh
+        self.copy = copy
+        self.level = level
+        self.buffer = bytearray()
+        self.address = 0
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while (len(self.buffer) >= BLOCK_SIZE):
+            self.writeBlock(bytes(self.buffer[:BLOCK_SIZE]))
+            del self.buffer[:BLOCK_SIZE]
+
+    def writeBlock(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        deflated = compressor.compress(data) + compressor.flush()
+        block = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + \
+            struct.pack('<H', len(deflated) + 25) + deflated + \
+            struct.pack('<II', zlib.crc32(data), len(data))
+        self.fh.write(block)
+        if self.copy is not None:
+            self.copy.write(block)
+        self.address = self.address + len(block)
+
+    def tell(self):
+        return (self.address << 16) | len(self.buffer)
+
+    def close(self):
+        if (len(self.buffer) > 0):
+            self.writeBlock(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+        if self.copy is not None:
+            self.copy.write(EOF_BLOCK)
+            self.copy.close()
+
+
+"""Tabix bin of the zero-based half open interval [beg, end)
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    shift = TBI_MIN_SHIFT
+    first = ((1 << (3 * TBI_DEPTH)) - 1) // 7
+    for level in range(TBI_DEPTH, 0, -1):
+        if (beg >> shift) == (end >> shift):
+            return first + (beg >> shift)
+        shift = shift + 3
+        first = first - (1 << (3 * (level - 1)))
+    return 0
+
+
+"""Tabix index of a coordinate-sorted VCF written to a BgzfFile
+   Records are added in file order with the virtual offsets of their
+   first byte and of the byte after them
+"""
+class TabixIndex(object):
+
+    def __init__(self):
+        self.names = []
+        self.refs = {}
+        self.last = None
+        self.sorted = True
+
+    def add(self, chrom, beg, end, start_offset, end_offset):
+        if (self.last is None) or (self.last[0] != chrom):
+            if chrom in self.refs:
+                self.sorted = False
+            self.names.append(chrom)
+            self.refs[chrom] = ({}, [])
+        elif (beg < self.last[1]):
+            self.sorted = False
+        self.last = (chrom, beg)
+
+        (bins, linear) = self.refs[chrom]
+        chunks = bins.setdefault(reg2bin(beg, end), [])
+        if (len(chunks) > 0) and (chunks[-1][1] == start_offset):
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+
+        last_window = max(beg, end - 1) >> TBI_MIN_SHIFT
+        if (last_window >= len(linear)):
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> TBI_MIN_SHIFT, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+
+    """Writes the index as a BGZF compressed .tbi file
+    """
+    def write(self, path):
+        names = b''.join([name.encode('utf-8') + b'\0' for name in self.names])
+        data = [b'TBI\1', struct.pack('<8i', len(self.names), TBI_FORMAT_VCF,
+            1, 2, 0, ord('#'), 0, len(names)), names]
+        for name in self.names:
+            (bins, linear) = self.refs[name]
+            data.append(struct.pack('<i', len(bins)))
+            for bin in sorted(bins):
+                data.append(struct.pack('<Ii', bin, len(bins[bin])))
+                for (start_offset, end_offset) in bins[bin]:
+                    data.append(struct.pack('<QQ', start_offset, end_offset))
+
+            # Windows without a record start at the offset of the window
+            # before them
+            offset = 0
+            data.append(struct.pack('<i', len(linear)))
+            for window_offset in linear:
+                if window_offset is not None:
+                    offset = window_offset
+                data.append(struct.pack('<Q', offset))
+
+        fh = BgzfFile(open(path, 'wb'))
+        fh.write(b''.join(data))
+        fh.close()
+
+
+"""Zero-based [beg, end) interval of a VCF record, as tabix computes it:
+   from POS and the REF length, or up to INFO END when it is present
+"""
+def getRecordInterval(fields):
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if (len(fields) > 7):
+        for item in fields[7].split(';'):
+            if item.startswith('END='):
+                try:
+                    end = max(end, int(item[len('END='):]))
+                except ValueError:
+                    pass
+                break
+    return (beg, max(end, beg + 1))
+
+
+"""Text writer of a BGZF compressed VCF, with a tabix index written to
+   index when the file is closed. Lines must be written whole. copy (e.g.
+   an s3stream.S3Upload) gets the compressed bytes as they are written.
+"""
+class VcfWriter(object):
+
+    def __init__(self, path, index=None, copy=None, sep='\t'):
+        self.bgzf = BgzfFile(open(path, 'wb'), copy=copy)
+        self.index = TabixIndex() if index else None
+        self.index_path = index
+        self.sep = sep
+
+    def write(self, s):
+        lines = s.split('\n')
+        for line in lines[:-1]:
+            start_offset = self.bgzf.tell()
+            self.bgzf.write((line + '\n').encode('utf-8'))
+            if (self.index is None) or line.startswith('#'):
+                continue
+            fields = line.split(self.sep, 8)
+            try:
+                (beg, end) = getRecordInterval(fields)
+            except (IndexError, ValueError):
+                continue
+            self.index.add(fields[0], beg, end, start_offset, self.bgzf.tell())
+        if lines[-1]:
+            self.bgzf.write(lines[-1].encode('utf-8'))
+        return len(s)
+
+    def close(self):
+        self.bgzf.close()
+        if self.index is None:
+            return
+        if self.index.sorted:
+            self.index.write(self.index_path)
+        else:
+            print(f"{self.index_path}: records are not sorted by " + \
+                "coordinate, no index written")
+
+
+"""Compresses a VCF to BGZF, with a tabix index if index is given
+"""
+def compressFile(infile, outfile, index=None, copy=None):
+    fh_out = VcfWriter(outfile, index=index, copy=copy)
+    with open(infile) as fh:
+        for line in fh:
+            fh_out.write(line)
+    fh_out.close()
+
+### EOF
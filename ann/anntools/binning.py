@@ -0,0 +1,185 @@
+# binning.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# UCSC bin index support for AnnTools
+#
+# UCSC tables such as refGene carry a "bin" column: the smallest block of
+# the standard binning scheme (128 kb blocks, each level 8 times larger,
+# up to 512 Mb) that holds the row's interval. Restricting a range query
+# to the few bins that can hold an overlapping row lets MySQL use the
+# (chrom, bin) index instead of scanning a wide range of starts.
+#
+# Usage:
+#   python binning.py migrate [table ...]
+#   python binning.py benchmark <table> [queries]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import sys
+import time
+import random
+import bundle as bn
+
+# First bin of each level, smallest blocks first
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+
+# Tables whose range queries can use bins, see bundle.BUNDLE_TABLES
+BIN_TABLES = ['refGene', 'cpgIslandExt', 'cytoBand', 'gadAll', 'targetScanS',
+    'hugo', 'dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv', 'genomicSuperDups'] + \
+    ['tfbsConsSites' + c for c in bn.TFBS_CHROMS]
+
+# Tables known to have (True) or lack (False) a bin column
+binned = {}
+
+
+"""Bin of the half open interval [start, end)
+   Empty intervals get the bin of their start
+"""
+def binFromRange(start, end):
+    start_bin = max(start, 0) >> BIN_FIRST_SHIFT
+    end_bin = max(start, end - 1, 0) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (start_bin == end_bin):
+            return offset + start_bin
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    raise ValueError(f"Interval {start}-{end} is out of the bin range")
+
+
+"""Bins of all blocks intersecting the half open interval [start, end)
+"""
+def getBins(start, end):
+    bins = []
+    start_bin = max(start, 0) >> BIN_FIRST_SHIFT
+    end_bin = max(start, end - 1, 0) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin = start_bin >> BIN_NEXT_SHIFT
+        end_bin = end_bin >> BIN_NEXT_SHIFT
+    return bins
+
+
+"""Bins that can hold a row with rowStart <= end AND start <= rowEnd
+   A row's bin holds [rowStart, rowEnd - 1] (or rowStart when empty), so
+   the blocks intersecting [start - 1, end] are enough
+"""
+def getQueryBins(start, end):
+    return getBins(start - 1, end + 1)
+
+
+"""SQL predicate restricting a query to the rows that can overlap
+   [start, end]
+"""
+def getBinSql(start, end):
+    return ' AND bin IN (' + \
+        ','.join([str(b) for b in getQueryBins(start, end)]) + ')'
+
+
+"""True if table has a bin column, checked once per process
+"""
+def hasBinColumn(cursor, table):
+    if table not in binned:
+        cursor.execute('select * from ' + table + ' limit 0;')
+        binned[table] = ('bin' in [d[0] for d in cursor.description])
+        cursor.fetchall()
+    return binned[table]
+
+
+"""SQL computing binFromRange(start, end) for a row
+"""
+def getBinExpression(start, end):
+    s = 'greatest(' + start + ', 0)'
+    e = 'greatest(' + end + ' - 1, ' + start + ', 0)'
+    sql = 'case'
+    shift = BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS[:-1]:
+        sql = sql + ' when ' + s + ' >> ' + str(shift) + ' = ' + e + \
+            ' >> ' + str(shift) + ' then ' + str(offset) + ' + (' + s + \
+            ' >> ' + str(shift) + ')'
+        shift = shift + BIN_NEXT_SHIFT
+    return sql + ' else 0 end'
+
+
+"""Adds a bin column and a (chrom, bin) index to the tables lacking one
+"""
+def migrate(tables=None):
+    import utils as u
+
+    specs = dict((t[0], t) for t in bn.BUNDLE_TABLES)
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    for table in (tables or BIN_TABLES):
+        (table, chrom, start, end) = specs[table]
+        if hasBinColumn(cursor, table):
+            print(f"{table}: has a bin column")
+            continue
+
+        cursor.execute('alter table ' + table + ' add column bin ' + \
+            'smallint unsigned not null default 0;')
+        cursor.execute('update ' + table + ' set bin = ' + \
+            getBinExpression(start, end) + ';')
+        cursor.execute('alter table ' + table + ' add index ' + table + \
+            '_bin (' + chrom + ', bin);')
+        conn.commit()
+        binned[table] = True
+        print(f"{table}: added bin column and index")
+    conn.close()
+
+
+"""Times the overlap query of a table at random positions of its rows,
+   with and without the bin predicate
+"""
+def benchmark(table, queries=1000):
+    import utils as u
+
+    (table, chrom, start, end) = dict((t[0], t)
+        for t in bn.BUNDLE_TABLES)[table]
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    if not hasBinColumn(cursor, table):
+        print(f"{table} has no bin column, run: python binning.py migrate {table}")
+        return
+
+    cursor.execute('select ' + chrom + ', ' + start + ', ' + end + \
+        ' from ' + table + ' order by rand() limit ' + str(queries) + ';')
+    points = [(str(row[0]), random.randint(int(row[1]), max(int(row[1]),
+        int(row[2])))) for row in cursor.fetchall()]
+
+    for use_bins in (False, True):
+        latencies = []
+        for (c, pos) in points:
+            sql = 'select * from ' + table + ' where ' + chrom + '="' + c + \
+                '" AND ' + start + ' <= ' + str(pos) + ' AND ' + str(pos) + \
+                ' <= ' + end
+            if use_bins:
+                sql = sql + getBinSql(pos, pos)
+            t = time.time()
+            cursor.execute(sql + ';')
+            cursor.fetchall()
+            latencies.append(time.time() - t)
+        latencies.sort()
+        n = len(latencies)
+        if (n > 0):
+            print(f"{table} {'bin' if use_bins else 'range'} queries: " + \
+                f"{n}, mean {1000 * sum(latencies) / n:.3f} ms, " + \
+                f"p50 {1000 * latencies[n // 2]:.3f} ms, " + \
+                f"p95 {1000 * latencies[min(n - 1, n * 95 // 100)]:.3f} ms")
+    conn.close()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'migrate'):
+        migrate(sys.argv[2:] or None)
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'benchmark'):
+        benchmark(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else 1000)
+    else:
+        print("Usage: python binning.py migrate [table ...]\n" + \
+            "       python binning.py benchmark <table> [queries]")
+
+### EOF
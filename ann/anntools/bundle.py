@@ -0,0 +1,498 @@
+# bundle.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Compiled reference bundle for AnnTools
+#
+# The export tool dumps the reference tables read by the annotation stages
+# from the annotator MySQL database into a directory of flat binary column
+# files, one set per table and chromosome, with rows sorted by start. The
+# reader memory-maps those files, so annotation runs without the database
+# and concurrent jobs on one instance share the same page cache.
+#
+# Usage:
+#   python bundle.py export <bundle_dir> [table ...]
+#   python bundle.py verify <bundle_dir>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+from array import array
+
+# Bumped whenever the on-disk layout or the row order changes
+BUNDLE_FORMAT = 2
+MANIFEST = 'MANIFEST.json'
+
+TFBS_CHROMS = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+    '14','15','16','17','18','19','20','21','22','X','Y']
+
+"""Tables read by the annotation stages: (table, chrom, start, end)
+   Rows are indexed on [start, end]; tables that are looked up by exact
+   position use the same column for both
+"""
+BUNDLE_TABLES = [('dbSNP', 'CHR', 'POS', 'POS'),
+    ('chrom_pos_equal_base', 'CHR', 'start', 'start'),
+    ('chrom_pos_equal_nobase', 'CHR', 'start', 'start'),
+    ('chrom_pos_unequal', 'CHR', 'start', 'end'),
+    ('refGene', 'chrom', 'txStart', 'txEnd'),
+    ('cpgIslandExt', 'chrom', 'chromStart', 'chromEnd'),
+    ('cytoBand', 'chrom', 'chromStart', 'chromEnd'),
+    ('gadAll', 'chromosome', 'chromStart', 'chromEnd'),
+    ('gwasCatalog', 'chrom', 'chromEnd', 'chromEnd'),
+    ('targetScanS', 'chrom', 'chromStart', 'chromEnd'),
+    ('hugo', 'chrom', 'chromStart', 'chromEnd'),
+    ('dgv_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('abParts_IG_T_CelReceptors', 'chrom', 'chromStart', 'chromEnd'),
+    ('mcCarroll_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('conrad_Cnv', 'chrom', 'chromStart', 'chromEnd'),
+    ('genomicSuperDups', 'chrom', 'chromStart', 'chromEnd')] + \
+    [('tfbsConsSites' + c, 'chrom', 'chromStart', 'chromEnd')
+        for c in TFBS_CHROMS]
+
+"""Column breaking the ties between rows with the same interval, for the
+   tables whose rows the stages report in order. Their rows are exported
+   ordered by start, end and this column, the order the stages query them
+   in (see GenesStage and stages.OverlapStage.getOrderColumns)
+"""
+NAME_COLUMNS = dict([('refGene', 'name'), ('cytoBand', 'name'), ('gadAll', 'geneSymbol'),
+    ('gwasCatalog', 'name'), ('targetScanS', 'name'), ('hugo', 'name'),
+    ('dgv_Cnv', 'name'), ('abParts_IG_T_CelReceptors', 'name'),
+    ('mcCarroll_Cnv', 'name'), ('conrad_Cnv', 'name'),
+    ('genomicSuperDups', 'name')] +
+    [('tfbsConsSites' + c, 'name') for c in TFBS_CHROMS])
+
+# Rows buffered in memory before they are appended to the column files
+FLUSH_ROWS = 100000
+
+
+"""Chromosome key, compared the way the default MySQL collation does
+"""
+def chromKey(chrom):
+    return str(chrom).upper().rstrip(' ')
+
+
+"""Appends the values of one column to flat binary files
+   ints and floats are stored as int64/float64; strings and blobs as one
+   byte blob plus int64 end offsets. NULLs are recorded in a separate
+   list of row numbers.
+"""
+class ColumnWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.kind = None
+        self.count = 0
+        self.pending = 0
+        self.nulls = array('q')
+        self.values = None
+        self.blob = bytearray()
+        self.offset = 0
+
+    def setKind(self, value):
+        if isinstance(value, bool) or \
+            not isinstance(value, (int, float, bytes)):
+            self.kind = 'str'
+        elif isinstance(value, int):
+            self.kind = 'int'
+        elif isinstance(value, float):
+            self.kind = 'float'
+        else:
+            self.kind = 'bytes'
+
+        if (self.kind == 'int'):
+            self.values = array('q')
+        elif (self.kind == 'float'):
+            self.values = array('d')
+        else:
+            self.values = array('q')
+
+        for i in range(self.pending):
+            self.addPlaceholder()
+        self.pending = 0
+
+    def addPlaceholder(self):
+        if self.kind in ('int', 'float'):
+            self.values.append(0)
+        else:
+            self.values.append(self.offset)
+
+    def add(self, value):
+        if value is None:
+            self.nulls.append(self.count)
+            if self.kind is None:
+                self.pending = self.pending + 1
+            else:
+                self.addPlaceholder()
+        else:
+            if self.kind is None:
+                self.setKind(value)
+            if self.kind in ('int', 'float'):
+                self.values.append(value)
+            else:
+                if (self.kind == 'str'):
+                    value = str(value).encode('utf-8')
+                self.blob.extend(value)
+                self.offset = self.offset + len(value)
+                self.values.append(self.offset)
+        self.count = self.count + 1
+
+    def flush(self):
+        if self.kind is None:
+            return
+        suffix = '.offsets' if self.kind in ('str', 'bytes') else '.data'
+        with open(self.path + suffix, 'ab') as fh:
+            self.values.tofile(fh)
+        self.values = array(self.values.typecode)
+        if self.kind in ('str', 'bytes'):
+            with open(self.path + '.blob', 'ab') as fh:
+                fh.write(self.blob)
+            self.blob = bytearray()
+
+    def close(self):
+        if self.kind is None:
+            # Only NULLs in this column
+            self.setKind('')
+        self.flush()
+        if self.kind in ('str', 'bytes') and \
+            not os.path.exists(self.path + '.blob'):
+            open(self.path + '.blob', 'wb').close()
+        with open(self.path + '.nulls', 'wb') as fh:
+            self.nulls.tofile(fh)
+        return self.kind
+
+
+"""Writes the rows of one table and chromosome, sorted by start
+"""
+class ChromWriter(object):
+
+    def __init__(self, path, ncolumns):
+        os.makedirs(path)
+        self.path = path
+        self.columns = [ColumnWriter(os.path.join(path, str(i)))
+            for i in range(ncolumns)]
+        self.starts = array('q')
+        self.ends = array('q')
+        self.maxend = array('q')
+        self.runningmax = None
+        self.rows = 0
+
+    def add(self, row, start, end):
+        for (column, value) in zip(self.columns, row):
+            column.add(value)
+        end = int(end)
+        self.runningmax = end if self.runningmax is None else \
+            max(self.runningmax, end)
+        self.starts.append(int(start))
+        self.ends.append(end)
+        self.maxend.append(self.runningmax)
+        self.rows = self.rows + 1
+        if (self.rows % FLUSH_ROWS == 0):
+            self.flush()
+
+    def flush(self):
+        for column in self.columns:
+            column.flush()
+        for name in ('starts', 'ends', 'maxend'):
+            with open(os.path.join(self.path, name), 'ab') as fh:
+                getattr(self, name).tofile(fh)
+            setattr(self, name, array('q'))
+
+    def close(self):
+        self.flush()
+        return {'rows': self.rows,
+            'kinds': [column.close() for column in self.columns]}
+
+
+"""Dumps one reference table into the bundle directory
+"""
+def exportTable(conn, cursor_class, path, table, chrom, start, end):
+    cursor = conn.cursor()
+    cursor.execute('select * from ' + table + ' limit 0;')
+    columns = [d[0] for d in cursor.description]
+    istart = columns.index(start)
+    iend = columns.index(end)
+
+    cursor.execute('select distinct ' + chrom + ' from ' + table + ';')
+    chroms = sorted(set([str(row[0]) for row in cursor.fetchall()
+        if row[0] is not None]))
+    cursor.close()
+
+    order = start
+    if table in NAME_COLUMNS:
+        order = start + ', ' + end + ', ' + NAME_COLUMNS[table]
+
+    spec = {'chrom': chrom, 'start': start, 'end': end,
+        'columns': columns, 'chroms': {}}
+    for (n, c) in enumerate(chroms):
+        writer = ChromWriter(os.path.join(path, table, str(n)), len(columns))
+        # Stream the rows instead of loading whole chromosomes in memory
+        cursor = conn.cursor(cursor_class)
+        cursor.execute('select * from ' + table + ' where ' + chrom + \
+            '="' + c + '" AND ' + start + ' is not null AND ' + end + \
+            ' is not null order by ' + order + ';')
+        for row in cursor:
+            writer.add(row, row[istart], row[iend])
+        cursor.close()
+        info = writer.close()
+        info['dir'] = str(n)
+        spec['chroms'][chromKey(c)] = info
+        print(f"{table} {c}: {info['rows']} rows")
+    return spec
+
+
+"""Content digest over all column files, used as the bundle version
+"""
+def computeVersion(path):
+    digest = hashlib.sha256()
+    for (dirpath, dirnames, filenames) in sorted(os.walk(path)):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if (name == MANIFEST):
+                continue
+            filename = os.path.join(dirpath, name)
+            digest.update(os.path.relpath(filename, path).encode('utf-8'))
+            with open(filename, 'rb') as fh:
+                for chunk in iter(lambda: fh.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+"""Exports the reference tables into a new bundle directory
+"""
+def export(path, tables=None):
+    import pymysql
+    import utils as u
+
+    specs = [t for t in BUNDLE_TABLES if (tables is None or t[0] in tables)]
+    if os.path.exists(path):
+        raise ValueError(f"Bundle directory '{path}' already exists")
+
+    # Build next to the destination and move it in place when complete
+    tmppath = path + '.tmp'
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+
+    conn = u.db_connect()
+    manifest = {'format': BUNDLE_FORMAT, 'created': int(time.time()),
+        'tables': {}}
+    for (table, chrom, start, end) in specs:
+        manifest['tables'][table] = exportTable(conn,
+            pymysql.cursors.SSCursor, tmppath, table, chrom, start, end)
+    conn.close()
+
+    manifest['version'] = computeVersion(tmppath)
+    with open(os.path.join(tmppath, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    os.rename(tmppath, path)
+    return manifest['version']
+
+
+"""Rows of one table and chromosome, memory-mapped
+"""
+class BundleChrom(object):
+
+    def __init__(self, path, info, ncolumns):
+        import numpy as np
+        self.np = np
+        self.rows = info['rows']
+        self.kinds = info['kinds']
+        self.starts = self.map(os.path.join(path, 'starts'), 'int64')
+        self.ends = self.map(os.path.join(path, 'ends'), 'int64')
+        self.maxend = self.map(os.path.join(path, 'maxend'), 'int64')
+        self.columns = []
+        for i in range(ncolumns):
+            base = os.path.join(path, str(i))
+            nulls = self.map(base + '.nulls', 'int64')
+            nulls = set(nulls.tolist()) if len(nulls) > 0 else None
+            if self.kinds[i] in ('str', 'bytes'):
+                self.columns.append((self.kinds[i], self.map(base + '.offsets',
+                    'int64'), self.map(base + '.blob', 'uint8'), nulls))
+            else:
+                self.columns.append((self.kinds[i], self.map(base + '.data',
+                    'int64' if self.kinds[i] == 'int' else 'float64'), None,
+                    nulls))
+
+    def map(self, filename, dtype):
+        if (os.path.getsize(filename) == 0):
+            return self.np.zeros(0, dtype=dtype)
+        return self.np.memmap(filename, dtype=dtype, mode='r')
+
+    def value(self, column, k):
+        (kind, data, blob, nulls) = self.columns[column]
+        if nulls is not None and k in nulls:
+            return None
+        if (kind == 'int'):
+            return int(data[k])
+        elif (kind == 'float'):
+            return float(data[k])
+        start = int(data[k - 1]) if k > 0 else 0
+        value = blob[start:int(data[k])].tobytes()
+        return value if kind == 'bytes' else value.decode('utf-8')
+
+    """Rows ks as tuples of the given columns, each column read for all of
+       them at once
+    """
+    def getRows(self, ks, indices):
+        np = self.np
+        karr = np.array(ks, dtype='int64')
+        columns = []
+        for i in indices:
+            (kind, data, blob, nulls) = self.columns[i]
+            if kind in ('int', 'float'):
+                values = data[karr].tolist()
+            else:
+                ends = data[karr].tolist()
+                starts = [0 if k == 0 else start for (k, start) in
+                    zip(ks, data[np.maximum(karr - 1, 0)].tolist())]
+                view = memoryview(blob)
+                values = [view[start:end].tobytes()
+                    for (start, end) in zip(starts, ends)]
+                if (kind == 'str'):
+                    values = [value.decode('utf-8') for value in values]
+            if nulls is not None:
+                values = [None if k in nulls else value
+                    for (k, value) in zip(ks, values)]
+            columns.append(values)
+        return list(zip(*columns))
+
+    """Row numbers with start <= end_pos and end >= start_pos, in start order
+       maxend is the running maximum of the ends, so rows before the first
+       maxend >= start_pos cannot overlap even when intervals are nested
+    """
+    def find(self, start_pos, end_pos):
+        np = self.np
+        hi = int(np.searchsorted(self.starts, end_pos, side='right'))
+        lo = int(np.searchsorted(self.maxend, start_pos, side='left'))
+        if (lo >= hi):
+            return []
+        return (np.nonzero(self.ends[lo:hi] >= start_pos)[0] + lo).tolist()
+
+    """Same bounds as find for an array of positions at once: the rows
+       overlapping position i are among rows lo[i] to hi[i] - 1. Row lo[i]
+       always is one of them when lo[i] < hi[i], since the first row whose
+       maxend reaches a position ends there itself
+    """
+    def findRanges(self, positions):
+        np = self.np
+        return (np.searchsorted(self.maxend, positions, side='left'),
+            np.searchsorted(self.starts, positions, side='right'))
+
+
+"""One exported table
+"""
+class BundleTable(object):
+
+    def __init__(self, path, spec):
+        self.path = path
+        self.spec = spec
+        self.columns = spec['columns']
+        self.chroms = {}
+
+    def index(self, column):
+        return self.columns.index(column)
+
+    def getChrom(self, chrom):
+        key = chromKey(chrom)
+        if key not in self.chroms:
+            info = self.spec['chroms'].get(key)
+            self.chroms[key] = None if info is None else \
+                BundleChrom(os.path.join(self.path, info['dir']), info,
+                    len(self.columns))
+        return self.chroms[key]
+
+    """Rows overlapping [start, end], as tuples like "select *" returns
+       or restricted to the given columns
+    """
+    def overlap(self, chrom, start, end, columns=None):
+        c = self.getChrom(chrom)
+        if c is None:
+            return []
+        indices = range(len(self.columns)) if columns is None else \
+            [self.index(x) for x in columns]
+        return [tuple([c.value(i, k) for i in indices])
+            for k in c.find(start, end)]
+
+    """Rows overlapping each of positions, the same lists overlap(chrom,
+       pos, pos) returns, found with one vectorized search for all of them.
+       With first=True only the first row of each list, in the export order
+       (see NAME_COLUMNS)
+    """
+    def overlapPositions(self, chrom, positions, columns=None, first=False):
+        c = self.getChrom(chrom)
+        if c is None:
+            return [[] for pos in positions]
+        indices = range(len(self.columns)) if columns is None else \
+            [self.index(x) for x in columns]
+        (lo, hi) = c.findRanges(c.np.array(positions, dtype='int64'))
+
+        matches = []
+        for (pos, l, h) in zip(positions, lo.tolist(), hi.tolist()):
+            if (l >= h):
+                matches.append([])
+            elif first or (h - l == 1):
+                matches.append([l])
+            else:
+                matches.append((c.np.nonzero(c.ends[l:h] >= pos)[0] +
+                    l).tolist())
+
+        # Neighbouring variants often fall in the same rows, read them once
+        ks = sorted(set([k for m in matches for k in m]))
+        rows = dict(zip(ks, c.getRows(ks, indices)))
+        return [[rows[k] for k in m] for m in matches]
+
+
+"""Reader for an exported bundle
+   Pass the expected version to refuse a bundle built from other data
+"""
+class Bundle(object):
+
+    def __init__(self, path, version=None):
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if (self.manifest.get('format') != BUNDLE_FORMAT):
+            raise ValueError(f"Unsupported bundle format in '{path}'")
+        self.version = self.manifest['version']
+        if version and (version != self.version):
+            raise ValueError(f"Reference bundle '{path}' has version " + \
+                f"{self.version}, expected {version}")
+        self.path = path
+        self.tables = {}
+
+    def hasTable(self, table):
+        return table in self.manifest['tables']
+
+    def getTable(self, table):
+        if table not in self.tables:
+            self.tables[table] = BundleTable(os.path.join(self.path, table),
+                self.manifest['tables'][table])
+        return self.tables[table]
+
+    """Recomputes the content digest, True if it matches the version stamp
+    """
+    def verify(self):
+        return (computeVersion(self.path) == self.version)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'export'):
+        version = export(sys.argv[2], sys.argv[3:] or None)
+        print(f"Reference bundle version: {version}")
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'verify'):
+        bundle = Bundle(sys.argv[2])
+        if bundle.verify():
+            print(f"Reference bundle version {bundle.version} verified")
+        else:
+            print(f"Reference bundle does not match version {bundle.version}")
+            sys.exit(1)
+    else:
+        print("Usage: python bundle.py export|verify <bundle_dir> [table ...]")
+
+### EOF
@@ -0,0 +1,197 @@
+# cache.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Cross-job annotation cache for AnnTools
+#
+# Keeps the reference rows found by the stage lookups in an SQLite file on
+# the annotator instance, so variants seen by earlier jobs are annotated
+# without querying the reference database. Entries are keyed by the
+# reference version, the stage and the variant key of the lookup, expire
+# after a TTL and the least recently used ones are evicted when the file
+# grows over its size cap, checked while a job adds entries and when it is
+# done. The file can be shared by concurrent jobs.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import time
+import pickle
+import sqlite3
+import threading
+
+# Default size cap of the cache file
+CACHE_SIZE = 1024 * 1024 * 1024
+# Default lifetime of an entry in seconds
+CACHE_TTL = 7 * 24 * 3600
+# Keys looked up per statement (SQLite limits the number of parameters)
+LOOKUP_SIZE = 500
+# Eviction removes entries until the cache is below this fraction of its cap
+EVICT_RATIO = 0.9
+
+
+"""Annotation cache stored in an SQLite file
+   version identifies the reference data (e.g. the reference bundle
+   version); entries cached with another version are never returned
+"""
+class AnnotationCache(object):
+
+    def __init__(self, path, version='', size=CACHE_SIZE, ttl=CACHE_TTL):
+        self.path = path
+        self.version = str(version)
+        self.size = size
+        self.ttl = ttl
+        self.local = threading.local()
+        # Connections of all threads, closed by close()
+        self.connections = []
+        # Bytes added since the size was last checked
+        self.added = 0
+        self.lock = threading.Lock()
+
+        conn = self.connect()
+        conn.execute('create table if not exists annotations ' + \
+            '(key text primary key, value blob not null, ' + \
+            'size integer not null, created real not null, used real not null)')
+        conn.execute('create index if not exists annotations_used ' + \
+            'on annotations (used)')
+        conn.commit()
+
+    """SQLite connection of the calling thread
+       Only used by that thread, but closed by the thread calling close()
+    """
+    def connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60,
+                check_same_thread=False)
+            conn.execute('pragma journal_mode=WAL')
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def getKey(self, stage, key):
+        return '\t'.join([self.version, stage.name] + [str(k) for k in key])
+
+    """Returns the cached values of keys, as a dictionary
+    """
+    def get(self, keys):
+        conn = self.connect()
+        now = time.time()
+        values = {}
+        for i in range(0, len(keys), LOOKUP_SIZE):
+            chunk = keys[i:i + LOOKUP_SIZE]
+            rows = conn.execute('select key, value from annotations ' + \
+                'where created > ? and key in (' + \
+                ','.join(['?'] * len(chunk)) + ')',
+                [now - self.ttl] + chunk).fetchall()
+            for (key, value) in rows:
+                values[key] = pickle.loads(value)
+
+        if (len(values) > 0):
+            conn.executemany('update annotations set used = ? where key = ?',
+                [(now, key) for key in values])
+        conn.commit()
+        return values
+
+    """Adds entries; evicts once the entries added since the last check
+       could have taken the cache over its cap
+    """
+    def put(self, items):
+        conn = self.connect()
+        now = time.time()
+        entries = []
+        for (key, value) in items:
+            value = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            entries.append((key, value, len(key) + len(value), now, now))
+        conn.executemany('insert or replace into annotations ' + \
+            '(key, value, size, created, used) values (?, ?, ?, ?, ?)',
+            entries)
+        conn.commit()
+
+        with self.lock:
+            self.added = self.added + sum([e[2] for e in entries])
+            due = (self.added >= self.size * (1 - EVICT_RATIO))
+            if due:
+                self.added = 0
+        if due:
+            self.evict()
+
+    """Runs the lookup of stage for the records missing in the cache, and
+       caches their rows. Updates the cache counters of the stage
+    """
+    def lookup(self, stage, cursor, records):
+        keys = []
+        for record in records:
+            key = stage.getCacheKey(record)
+            keys.append(None if key is None else self.getKey(stage, key))
+
+        values = self.get(list(set([k for k in keys if k is not None])))
+        missing = [i for (i, key) in enumerate(keys) if key not in values]
+        found = [values.get(key) for key in keys]
+
+        if (len(missing) > 0):
+            rows = stage.lookup(cursor, [records[i] for i in missing])
+            for (i, r) in zip(missing, rows):
+                found[i] = [tuple(row) for row in r]
+            self.put(dict((keys[i], found[i]) for i in missing
+                if keys[i] is not None).items())
+
+        stage.cache_hits = stage.cache_hits + len(records) - len(missing)
+        stage.cache_misses = stage.cache_misses + len(missing)
+        return found
+
+    """Drops expired entries, then the least recently used ones until the
+       cache is below EVICT_RATIO of its size cap
+    """
+    def evict(self):
+        conn = self.connect()
+        conn.execute('delete from annotations where created <= ?',
+            (time.time() - self.ttl,))
+        total = conn.execute('select coalesce(sum(size), 0) ' + \
+            'from annotations').fetchone()[0]
+
+        if (total > self.size):
+            # Entries used at the same time are ordered by key, so exactly
+            # the entries counted here are deleted
+            limit = self.size * EVICT_RATIO
+            cursor = conn.execute('select size from annotations ' + \
+                'order by used, key')
+            count = 0
+            for (size,) in cursor:
+                count = count + 1
+                total = total - size
+                if (total <= limit):
+                    break
+            cursor.close()
+            conn.execute('delete from annotations where key in ' + \
+                '(select key from annotations order by used, key limit ?)',
+                (count,))
+        conn.commit()
+
+    """Closes the connections of all threads
+    """
+    def close(self):
+        with self.lock:
+            connections = self.connections
+            self.connections = []
+        for conn in connections:
+            conn.close()
+        self.local = threading.local()
+
+
+"""Cache counters of the stages written to the .count.log file, nothing if
+   the cache was not used
+"""
+def logLines(stages):
+    lines = []
+    for stage in stages:
+        if (stage.cache_hits + stage.cache_misses > 0):
+            lines.append(f"{stage.name}: {str(stage.cache_hits)} hits, " + \
+                f"{str(stage.cache_misses)} misses\n")
+    if (len(lines) > 0):
+        lines.insert(0, "Annotation cache:\n")
+    return lines
+
+### EOF
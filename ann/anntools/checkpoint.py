@@ -0,0 +1,140 @@
+# checkpoint.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Job checkpoints for AnnTools
+#
+# Saves the progress of a single-pass engine run to S3 at a fixed interval:
+# the number of input lines annotated so far, the stage counters, and the
+# annotated lines written since the previous checkpoint as a new segment.
+# A job restarted on another instance (e.g. when its SQS message is
+# redelivered after the instance was scaled in) replays the segments into
+# its output, restores the counters and continues after the last saved
+# line instead of annotating the input from line 1.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import json
+import time
+import s3stream as s3
+
+# Bumped whenever the checkpoint layout changes
+CHECKPOINT_FORMAT = 1
+MANIFEST = 'checkpoint.json'
+
+# Default seconds between checkpoints
+CHECKPOINT_INTERVAL = 300
+# Objects deleted per request (the S3 limit)
+DELETE_SIZE = 1000
+
+
+"""Checkpoints of a job stored under an s3://bucket/prefix URL
+   The annotated output is tracked through the file object returned by
+   track(); save() uploads what was written since the previous save
+"""
+class Checkpoint(object):
+
+    def __init__(self, url, interval=CHECKPOINT_INTERVAL, client=None):
+        (self.bucket, prefix) = s3.parseS3Url(url)
+        self.prefix = prefix.rstrip('/') + '/'
+        self.interval = interval
+        if client is None:
+            client = s3.getClient()
+        self.client = client
+        self.segments = []
+        self.segment = None
+        self.path = None
+        self.saved = time.time()
+
+    def getKey(self, name):
+        return self.prefix + name
+
+    """Returns the saved manifest of infile, None if there is none
+    """
+    def load(self, infile):
+        try:
+            response = self.client.get_object(Bucket=self.bucket,
+                Key=self.getKey(MANIFEST))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        manifest = json.loads(response['Body'].read())
+        if (manifest.get('format') != CHECKPOINT_FORMAT) or \
+            (manifest.get('infile') != os.path.basename(infile)):
+            return None
+        return manifest
+
+    """Writes the saved output of infile to fh_out and adds the saved
+       counters to stages. Returns the number of input lines covered by
+       the checkpoint, 0 if there is none
+    """
+    def restore(self, infile, fh_out, stages):
+        manifest = self.load(infile)
+        if manifest is None:
+            return 0
+
+        path = infile + '.restore'
+        for name in manifest['segments']:
+            s3.spool(self.bucket, self.getKey(name), path, client=self.client)
+            with open(path) as fh:
+                for line in fh:
+                    fh_out.write(line)
+            os.unlink(path)
+        for (stage, counters) in zip(stages, manifest['counters']):
+            stage.addCounters(counters)
+
+        self.segments = manifest['segments']
+        print(f"Resuming after line {manifest['lines']}")
+        return manifest['lines']
+
+    """Returns a file object writing to fh_out and to the segment of the
+       next checkpoint, kept in path
+    """
+    def track(self, fh_out, path):
+        self.path = path
+        self.segment = open(path, 'w')
+        return s3.TeeWriter(fh_out, self)
+
+    def write(self, s):
+        return self.segment.write(s)
+
+    def close(self):
+        self.segment.close()
+
+    def isDue(self):
+        return (time.time() - self.saved >= self.interval)
+
+    """Uploads the output written since the previous checkpoint, then the
+       manifest recording that the first lines of infile are done
+    """
+    def save(self, infile, lines, stages):
+        self.segment.close()
+        if (os.path.getsize(self.path) > 0):
+            name = 'segment_' + str(len(self.segments) + 1)
+            self.client.upload_file(self.path, self.bucket, self.getKey(name))
+            self.segments.append(name)
+
+        manifest = {'format': CHECKPOINT_FORMAT,
+            'infile': os.path.basename(infile), 'lines': lines,
+            'segments': self.segments, 'created': int(time.time()),
+            'counters': [stage.getCounters() for stage in stages]}
+        self.client.put_object(Bucket=self.bucket, Key=self.getKey(MANIFEST),
+            Body=json.dumps(manifest).encode('utf-8'))
+
+        self.segment = open(self.path, 'w')
+        self.saved = time.time()
+
+    """Deletes the checkpoint once the job is done
+    """
+    def clear(self):
+        keys = [self.getKey(MANIFEST)] + \
+            [self.getKey(name) for name in self.segments]
+        for i in range(0, len(keys), DELETE_SIZE):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + DELETE_SIZE]]})
+        if (self.path is not None) and os.path.exists(self.path):
+            os.unlink(self.path)
+
+### EOF
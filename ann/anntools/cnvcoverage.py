@@ -0,0 +1,175 @@
+# cnvcoverage.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Coverage maps of the CNV tables for AnnTools
+#
+# The CNV stages only report whether any row of dgv_Cnv,
+# abParts_IG_T_CelReceptors, mcCarroll_Cnv or conrad_Cnv covers the
+# position of a variant, never what the row holds. The build tool merges
+# the intervals of each table into the sorted, disjoint runs of positions
+# they cover, one pair of int64 files (run starts, run ends) per chromosome.
+# The reader memory-maps them, so the jobs on one instance share the same
+# pages, and answers a block of positions with one binary search per
+# chromosome. The runs of all four tables take a few MB.
+# The maps must be rebuilt whenever the reference tables change.
+#
+# Usage:
+#   python cnvcoverage.py build <coverage_dir> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import time
+import shutil
+from array import array
+import bundle as bn
+
+# Bumped whenever the on-disk layout changes
+COVERAGE_FORMAT = 1
+MANIFEST = 'MANIFEST.json'
+
+# Tables mapped by default, the ones of the CNV stages
+COVERAGE_TABLES = ['dgv_Cnv', 'abParts_IG_T_CelReceptors', 'mcCarroll_Cnv',
+    'conrad_Cnv']
+
+
+"""Merges [start, end] intervals into the sorted, disjoint runs of the
+   integer positions they cover; returns the run starts and ends
+"""
+def mergeIntervals(intervals):
+    starts = array('q')
+    ends = array('q')
+    for (start, end) in sorted(intervals):
+        if (len(ends) > 0) and (start <= ends[-1] + 1):
+            ends[-1] = max(ends[-1], end)
+        else:
+            starts.append(start)
+            ends.append(end)
+    return (starts, ends)
+
+
+"""Builds the coverage runs of every chromosome of a table
+"""
+def buildTable(conn, cursor_class, path, table, chrom, start, end):
+    intervals = {}
+    cursor = conn.cursor(cursor_class)
+    cursor.execute('select ' + chrom + ', ' + start + ', ' + end + \
+        ' from ' + table + ' where ' + chrom + ' is not null AND ' + \
+        start + ' is not null AND ' + end + ' is not null;')
+    for row in cursor:
+        # Rows ending before they start never match a position
+        if (int(row[1]) <= int(row[2])):
+            intervals.setdefault(bn.chromKey(row[0]), []).append(
+                (int(row[1]), int(row[2])))
+    cursor.close()
+
+    os.makedirs(os.path.join(path, table))
+    spec = {'chroms': {}}
+    nruns = 0
+    for (n, c) in enumerate(sorted(intervals)):
+        (starts, ends) = mergeIntervals(intervals[c])
+        for (name, values) in (('starts', starts), ('ends', ends)):
+            with open(os.path.join(path, table, str(n) + '.' + name),
+                'wb') as fh:
+                values.tofile(fh)
+        spec['chroms'][c] = {'dir': str(n), 'runs': len(starts)}
+        nruns = nruns + len(starts)
+    print(f"{table}: {nruns} runs on {len(intervals)} chromosomes")
+    return spec
+
+
+"""Builds the coverage maps of tables into a new directory, replacing
+   the previous maps once complete
+"""
+def build(path, tables=None):
+    import pymysql
+    import utils as u
+
+    if tables is None:
+        tables = COVERAGE_TABLES
+    specs = dict((t[0], t) for t in bn.BUNDLE_TABLES)
+
+    tmppath = path + '.tmp'
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+
+    conn = u.db_connect()
+    manifest = {'format': COVERAGE_FORMAT, 'created': int(time.time()),
+        'tables': {}}
+    for table in tables:
+        (table, chrom, start, end) = specs[table]
+        manifest['tables'][table] = buildTable(conn,
+            pymysql.cursors.SSCursor, tmppath, table, chrom, start, end)
+    conn.close()
+
+    with open(os.path.join(tmppath, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmppath, path)
+
+
+"""Reader for a coverage directory
+"""
+class Coverage(object):
+
+    def __init__(self, path):
+        import numpy as np
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if (self.manifest.get('format') != COVERAGE_FORMAT):
+            raise ValueError(f"Unsupported coverage format in '{path}'")
+        self.np = np
+        self.path = path
+        self.runs = {}
+
+    def hasTable(self, table):
+        return table in self.manifest['tables']
+
+    def map(self, filename):
+        if (os.path.getsize(filename) == 0):
+            return self.np.zeros(0, dtype='int64')
+        return self.np.memmap(filename, dtype='int64', mode='r')
+
+    """Run starts and ends of table on chrom, None if it has no rows there
+    """
+    def getRuns(self, table, chrom):
+        key = (table, bn.chromKey(chrom))
+        if key not in self.runs:
+            info = self.manifest['tables'][table]['chroms'].get(key[1])
+            if info is None:
+                self.runs[key] = None
+            else:
+                base = os.path.join(self.path, table, info['dir'])
+                self.runs[key] = (self.map(base + '.starts'),
+                    self.map(base + '.ends'))
+        return self.runs[key]
+
+    """For each of positions, True if a row of table on chrom covers it
+       The last run starting at or before a position is the only one
+       that can cover it, since runs are disjoint
+    """
+    def covers(self, table, chrom, positions):
+        runs = self.getRuns(table, chrom)
+        if (runs is None) or (len(runs[0]) == 0):
+            return [False for pos in positions]
+        np = self.np
+        (starts, ends) = runs
+        positions = np.array(positions, dtype='int64')
+        i = np.searchsorted(starts, positions, side='right') - 1
+        return ((i >= 0) & (ends[np.maximum(i, 0)] >= positions)).tolist()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'build'):
+        build(sys.argv[2], sys.argv[3:] or None)
+    else:
+        print("Usage: python cnvcoverage.py build <coverage_dir> [table ...]")
+
+### EOF
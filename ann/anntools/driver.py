@@ -14,11 +14,76 @@ import sys
 import os
 import file_utils as fu
 import annotate as ann
-
-def run(infile, format):
+import engine
+import shards
+import s3stream as s3
+import bgzf
+import metrics as mt
+
+"""Annotates infile with all reference tables
+   By default the single-pass engine is used; fused=False runs the original
+   chain of annotate.py stages with one intermediate file per stage.
+   processes > 0 shards the input by chromosome and annotates the shards
+   on that many processes. With an s3://bucket/key source the input is
+   streamed from S3 while it is annotated; the modes reading the input
+   more than once first spool it to infile. sink (an s3stream.S3Upload)
+   gets a copy of the annotated output and is closed when it is complete.
+   The input may be gzip or BGZF compressed; compress=True writes a BGZF
+   .annot.vcf.gz output with a tabix index. A checkpoint.Checkpoint saves
+   and resumes the progress of single-process engine runs; sharded and
+   staged runs start over. metrics=True writes the time, lines and SQL
+   queries of every engine stage to the .metrics.json sidecar of the
+   .count.log file. Other keyword options are passed on to engine.run
+"""
+def run(infile, format, fused=True, processes=0, source=None, sink=None,
+    compress=False, checkpoint=None, metrics=False,
+    source_chunksize=s3.CHUNK_SIZE, source_readahead=s3.READ_AHEAD,
+    **options):
 
     print("Running . . .")
 
+    s3_source = s3.parseS3Url(source) if source else None
+    if fused:
+        recorder = mt.Metrics() if metrics else None
+        if (s3_source is not None) and (processes <= 0):
+            fh = s3.openS3(*s3_source, chunksize=source_chunksize,
+                readahead=source_readahead)
+            try:
+                engine.run(infile, format=format, source=fh, sink=sink,
+                    compress=compress, checkpoint=checkpoint,
+                    metrics=recorder, **options)
+            finally:
+                fh.close()
+        else:
+            if s3_source is not None:
+                s3.spool(*s3_source, infile)
+            if (processes > 0):
+                shards.run(infile, format=format, processes=processes,
+                    sink=sink, compress=compress, metrics=recorder, **options)
+            else:
+                engine.run(infile, format=format, sink=sink,
+                    compress=compress, checkpoint=checkpoint,
+                    metrics=recorder, **options)
+        if recorder is not None:
+            recorder.write(engine.getMetricsFileName(infile))
+        return
+
+    if s3_source is not None:
+        s3.spool(*s3_source, infile)
+
+    # The staged pipeline reads plain text files only
+    compressed_infile = None
+    if bgzf.isGzip(infile):
+        compressed_infile = infile
+        infile = bgzf.stripGz(infile)
+        if (infile == compressed_infile):
+            infile = infile + '.vcf'
+        fh = bgzf.openText(compressed_infile)
+        with open(infile, 'w') as fh_plain:
+            for line in fh:
+                fh_plain.write(line)
+        fh.close()
+
     ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
         tmpextout='.1')
     print("dbSNP - done.")
@@ -118,4 +183,18 @@ def run(infile, format):
     finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
     os.rename(infile + '.annot', finalout)
 
+    if compressed_infile is not None:
+        fu.delete(infile)
+
+    # The staged pipeline only has the complete output at the end
+    if compress:
+        bgzf.compressFile(finalout, finalout + '.gz',
+            index=engine.getIndexFileName(infile), copy=sink)
+        fu.delete(finalout)
+    elif sink is not None:
+        with open(finalout) as fh:
+            for line in fh:
+                sink.write(line)
+        sink.close()
+
 ### EOF
\ No newline at end of file
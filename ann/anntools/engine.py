@@ -0,0 +1,306 @@
+# engine.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Single-pass annotation engine for AnnTools
+#
+# Reads the input VCF once, runs every record through all annotation
+# stages in memory and writes a single output file. The output and the
+# .count.log are identical to the ones produced by chaining the annotate.py
+# functions through intermediate files.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import time
+import concurrent.futures
+import utils as u
+import stages as st
+import record as rec
+import annotate as ann
+import s3stream as s3
+import bgzf
+import bundle as bn
+import cache as ch
+import prefilter as pf
+import cnvcoverage as cv
+
+# Number of records annotated together
+BLOCK_SIZE = 2000
+
+
+"""Name of the annotated output file for an input file (.vcf or .vcf.gz)
+"""
+def getAnnotatedFileName(infile, compress=False):
+    outfile = (bgzf.stripGz(infile) + '.annot').replace('.vcf.annot',
+        '.annot.vcf')
+    return outfile + '.gz' if compress else outfile
+
+
+"""Name of the JSON metrics sidecar of the .count.log file
+"""
+def getMetricsFileName(infile):
+    return bgzf.stripGz(infile) + '.metrics.json'
+
+
+"""Name of the tabix index of the compressed output file
+"""
+def getIndexFileName(infile):
+    return getAnnotatedFileName(infile, compress=True) + '.tbi'
+
+
+"""Opens the output written for infile: plain text, or BGZF with its tabix
+   index if compress is set. sink gets a copy of what is written to the
+   file
+"""
+def openOutput(outfile, infile, compress=False, sink=None):
+    if compress:
+        return bgzf.VcfWriter(outfile, index=getIndexFileName(infile),
+            copy=sink)
+    fh_out = open(outfile, 'w')
+    if sink is not None:
+        fh_out = s3.TeeWriter(fh_out, sink)
+    return fh_out
+
+
+"""Cursor passed to a stage, recording its queries when metrics (see
+   metrics.py) are collected
+"""
+def getStageCursor(cursor, stage, metrics=None):
+    if (metrics is None) or (cursor is None):
+        return cursor
+    return metrics.wrap(cursor, stage.name)
+
+
+"""Looks up the rows of an independent stage on a pool thread, with the
+   database connection of that thread
+"""
+def lookupBlock(stage, records, bundle=None, metrics=None):
+    start = time.time()
+    cursor = None
+    if not bundle:
+        cursor = u.RetryCursor()
+    found = stage.lookupCached(getStageCursor(cursor, stage, metrics), records)
+    if metrics is not None:
+        metrics.addTime(stage.name, time.time() - start)
+    return found
+
+
+"""Runs all stages on a block of records and writes them out
+   Without a cursor the shared database connection is checked out (and
+   pinged) for the block, so a connection dropped between blocks is
+   replaced; a statement hitting a connection dropped during the block is
+   retried once on a new one (see utils.RetryCursor).
+   With a thread pool the lookups of the independent stages start right
+   away on a copy of the records; their rows are applied in stage order
+   once the stages before them are done, so the INFO field is unchanged.
+"""
+def annotateBlock(cursor, stages, records, fh_out, bundle=None, pool=None,
+    metrics=None):
+    if (cursor is None) and not bundle:
+        cursor = u.RetryCursor()
+
+    found = {}
+    if pool is not None:
+        snapshot = [record.copy() for record in records]
+        for stage in stages:
+            if stage.independent:
+                found[stage] = pool.submit(lookupBlock, stage, snapshot,
+                    bundle, metrics)
+
+    for stage in stages:
+        if stage in found:
+            rows = found[stage].result()
+        start = time.time()
+        if stage in found:
+            stage.applyFound(records, rows)
+        else:
+            stage.annotate(getStageCursor(cursor, stage, metrics), records)
+        for record in records:
+            record.restrip()
+        if metrics is not None:
+            metrics.addTime(stage.name, time.time() - start, len(records))
+
+    for record in records:
+        fh_out.write(record.getLine() + '\n')
+
+
+"""Checks that records come in coordinate order: every chromosome in one
+   run of records, with positions that do not decrease
+"""
+class SortOrder(object):
+
+    def __init__(self):
+        self.chrom = None
+        self.pos = 0
+        self.done = set()
+
+    """False if record is out of order
+    """
+    def add(self, record):
+        if not record.pos.isdigit():
+            return True
+        pos = int(record.pos)
+        if (record.chrom != self.chrom):
+            if record.chrom in self.done:
+                return False
+            self.done.add(self.chrom)
+            self.chrom = record.chrom
+        elif (pos < self.pos):
+            return False
+        self.pos = pos
+        return True
+
+
+"""Turns sweep mode off for the rest of the input once it turns out not to
+   be coordinate sorted: the range of every block would then span most of
+   a chromosome and the tables would be read again for every block. The
+   overlap stages go back to the JOIN or per-variant lookups
+"""
+def stopSweep(stages, nlines):
+    print(f"Input is not coordinate sorted (line {nlines}), " + \
+        "sweep mode turned off")
+    for stage in stages:
+        if getattr(stage, 'sweep', False):
+            stage.sweep = False
+
+
+"""Annotates infile in a single pass
+   join=True annotates the overlap tables with one JOIN per block; use a
+   blocksize larger than the input to get one query per table for the job.
+   sweep=True merges each block with the overlap tables instead, which is
+   linear in variants plus table rows for coordinate-sorted input; it is
+   turned off at the first record out of order.
+   With a reference bundle directory all lookups are answered locally and
+   no database connection is opened.
+   threads > 0 runs the lookups of the overlap stages concurrently on that
+   many threads, each with its own database connection.
+   With a cache file the rows found by the lookups are kept across jobs,
+   keyed by the bundle version (cache_version without a bundle). Without
+   either version the cache is turned off, since nothing would tell the
+   entries found before a reload of the database apart.
+   A prefilter directory (see prefilter.py) skips the database lookups
+   that cannot match, and coverage maps (see cnvcoverage.py) answer the
+   CNV lookups without reading their rows. bins=True restricts the
+   per-variant range queries with UCSC bin predicates (see binning.py).
+   source is an open file to read the input from instead of infile, e.g. a
+   stream of the S3 object; the output files are still named after infile.
+   sink (e.g. an s3stream.S3Upload) gets a copy of the annotated output as
+   it is written, and is closed once the last block is written.
+   Gzip or BGZF input is decompressed as it is read; compress=True writes
+   the output as .annot.vcf.gz with a tabix index (see bgzf.py).
+   With a checkpoint (see checkpoint.py) a saved run of infile is resumed,
+   and the progress is saved after a block whenever the checkpoint is due.
+   A metrics.Metrics records the time, lines and queries of every stage.
+   Returns the stages, holding the counters of the run
+"""
+def run(infile, format='vcf', stages=None, blocksize=BLOCK_SIZE, join=False,
+    sweep=False, bundle=None, bundle_version=None, threads=0, cache=None,
+    cache_version='', cache_size=ch.CACHE_SIZE, cache_ttl=ch.CACHE_TTL,
+    prefilter=None, coverage=None, bins=False, source=None, sink=None,
+    compress=False, checkpoint=None, metrics=None, sep='\t'):
+    if bundle:
+        bundle = bn.Bundle(bundle, version=bundle_version)
+        cache_version = bundle.version
+    if stages is None:
+        stages = st.defaultStages(format=format, join=join, sweep=sweep,
+            bundle=bundle or None, bins=bins)
+    if cache and not cache_version:
+        print("No reference version set for the annotation cache, " + \
+            "annotation cache turned off")
+        cache = None
+    if cache:
+        cache = ch.AnnotationCache(cache, version=cache_version,
+            size=cache_size, ttl=cache_ttl)
+        for stage in stages:
+            stage.cache = cache
+    if prefilter and not bundle:
+        prefilter = pf.Prefilter(prefilter)
+        for stage in stages:
+            stage.prefilter = prefilter
+    if coverage:
+        coverage = cv.Coverage(coverage)
+        for stage in stages:
+            stage.coverage = coverage
+
+    tmpfile = infile + '.annot'
+    inds = ann.getFormatSpecificIndices(format=format)
+    cursor = None
+    pool = None
+    if (threads > 0):
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    order = None
+    if any([getattr(stage, 'sweep', False) for stage in stages]):
+        order = SortOrder()
+
+    fh = bgzf.openText(infile) if source is None else source
+    fh_out = openOutput(tmpfile, infile, compress=compress, sink=sink)
+    records = []
+
+    skip = 0
+    if checkpoint is not None:
+        skip = checkpoint.restore(infile, fh_out, stages)
+        fh_out = checkpoint.track(fh_out, tmpfile + '.checkpoint')
+
+    nlines = 0
+    for line in fh:
+        nlines = nlines + 1
+        if (nlines <= skip):
+            continue
+        line = line.strip()
+        if line.startswith('#'):
+            # Keep headers in place relative to the records around them
+            if (len(records) > 0):
+                annotateBlock(cursor, stages, records, fh_out, bundle,
+                    pool, metrics)
+                records = []
+            fh_out.write(line + '\n')
+        else:
+            record = rec.VariantRecord(line, inds, sep)
+            records.append(record)
+            if (order is not None) and not order.add(record):
+                stopSweep(stages, nlines)
+                order = None
+            if (len(records) >= blocksize):
+                annotateBlock(cursor, stages, records, fh_out, bundle,
+                    pool, metrics)
+                records = []
+                if (checkpoint is not None) and checkpoint.isDue():
+                    checkpoint.save(infile, nlines, stages)
+
+    if (len(records) > 0):
+        annotateBlock(cursor, stages, records, fh_out, bundle, pool,
+            metrics)
+
+    fh.close()
+    fh_out.close()
+    if pool is not None:
+        pool.shutdown()
+    if cache:
+        cache.evict()
+        cache.close()
+
+    writeCountLog(infile, stages)
+    for stage in stages:
+        print(f"{stage.name} - done.")
+
+    os.rename(tmpfile, getAnnotatedFileName(infile, compress=compress))
+    if checkpoint is not None:
+        checkpoint.clear()
+    return stages
+
+
+"""Writes the .count.log file of infile from the stage counters
+"""
+def writeCountLog(infile, stages):
+    fh_log = open(bgzf.stripGz(infile) + '.count.log', 'w')
+    for stage in stages:
+        fh_log.write(''.join(stage.logLines()))
+    fh_log.write(''.join(ch.logLines(stages)))
+    fh_log.write(''.join(pf.logLines(stages)))
+    fh_log.close()
+
+### EOF
@@ -0,0 +1,403 @@
+# localdb.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# SQLite stand-in for the reference database
+#
+# Holds the tables read by the annotation stages, with the column layout
+# the stages and annotate.py expect, in an SQLite file. When the
+# ANNTOOLS_SQLITE_DB environment variable names such a file,
+# utils.db_connect() returns a connection to it instead of RDS, so the
+# pipeline can be run and benchmarked without the reference database.
+# The tables are either generated around the variants of some VCF files,
+# with a configurable density of matches, or sampled from a region of the
+# reference database.
+#
+# Usage:
+#   python localdb.py generate <db_file> <vcf> [vcf ...]
+#   python localdb.py sample <db_file> <chrom:start-end>
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import re
+import sys
+import random
+import sqlite3
+import bgzf
+import bundle as bn
+import binning as bi
+
+# Seed of the generated tables
+SEED = 7
+
+REFGENE_COLUMNS = [('CHR', 'text'), ('start', 'int'), ('end', 'int'),
+    ('haplotypeReference', 'text'), ('haplotypeAlternate', 'text'),
+    ('name', 'text'), ('name2', 'text'), ('transcriptStrand', 'text'),
+    ('positionType', 'text'), ('frame', 'text'), ('mrnaCoord', 'text'),
+    ('codonCoord', 'text'), ('spliceDist', 'text'),
+    ('referenceCodon', 'text'), ('referenceAA', 'text'),
+    ('variantCodon', 'text'), ('variantAA', 'text'), ('changesAA', 'text'),
+    ('functionalClass', 'text'), ('codingCoordStr', 'text'),
+    ('proteinCoordStr', 'text'), ('inCodingRegion', 'text'),
+    ('spliceInfo', 'text'), ('uorfChange', 'text')]
+INTERVAL_COLUMNS = [('bin', 'int'), ('chrom', 'text'), ('chromStart', 'int'),
+    ('chromEnd', 'int'), ('name', 'text')]
+
+# Columns of the reference tables, in the order the stages read them
+SCHEMAS = dict([
+    ('dbSNP', [('CHR', 'text'), ('POS', 'int'), ('REF', 'text'),
+        ('RSID', 'text'), ('ALT', 'text'), ('QUAL', 'text'),
+        ('FILTER', 'text'), ('GMAF', 'text'), ('INFO', 'text')]),
+    ('chrom_pos_equal_base', [('id', 'int')] + REFGENE_COLUMNS),
+    ('chrom_pos_equal_nobase', [('id', 'int')] + REFGENE_COLUMNS),
+    ('chrom_pos_unequal', [('id', 'int')] + REFGENE_COLUMNS),
+    ('refGene', [('bin', 'int'), ('name', 'text'), ('chrom', 'text'),
+        ('strand', 'text'), ('txStart', 'int'), ('txEnd', 'int'),
+        ('cdsStart', 'int'), ('cdsEnd', 'int'), ('exonCount', 'int'),
+        ('exonStarts', 'blob'), ('exonEnds', 'blob'), ('score', 'int'),
+        ('name2', 'text'), ('cdsStartStat', 'text'), ('cdsEndStat', 'text'),
+        ('exonFrames', 'blob')]),
+    ('cpgIslandExt', INTERVAL_COLUMNS),
+    ('cytoBand', [('chrom', 'text'), ('chromStart', 'int'),
+        ('chromEnd', 'int'), ('name', 'text'), ('gieStain', 'text')]),
+    ('gadAll', [('id', 'int'), ('chromosome', 'text'), ('chromStart', 'int'),
+        ('chromEnd', 'int'), ('geneSymbol', 'text')]),
+    ('gwasCatalog', INTERVAL_COLUMNS + [('pubMedID', 'text'),
+        ('author', 'text'), ('pubDate', 'text'), ('journal', 'text'),
+        ('title', 'text'), ('trait', 'text')]),
+    ('targetScanS', INTERVAL_COLUMNS + [('score', 'int'), ('strand', 'text')]),
+    ('hugo', INTERVAL_COLUMNS + [('symbol', 'text'), ('descr', 'text')]),
+    ('dgv_Cnv', INTERVAL_COLUMNS),
+    ('abParts_IG_T_CelReceptors', INTERVAL_COLUMNS),
+    ('mcCarroll_Cnv', INTERVAL_COLUMNS),
+    ('conrad_Cnv', INTERVAL_COLUMNS),
+    ('genomicSuperDups', INTERVAL_COLUMNS + [('score', 'int'),
+        ('strand', 'text'), ('otherChrom', 'text'), ('otherStart', 'int'),
+        ('otherEnd', 'int')])] +
+    [('tfbsConsSites' + c, INTERVAL_COLUMNS + [('score', 'int'),
+        ('strand', 'text')]) for c in bn.TFBS_CHROMS])
+
+# Generated rows per variant, or one row per that many variants (and
+# largest interval length) for the interval tables
+DBSNP_RATE = 0.4
+REFGENE_RATES = [('chrom_pos_equal_base', 0.25),
+    ('chrom_pos_equal_nobase', 0.15), ('chrom_pos_unequal', 0.15)]
+GWAS_RATE = 0.05
+INTERVAL_DENSITY = [('gadAll', 40, 5000), ('targetScanS', 30, 200),
+    ('hugo', 20, 20000), ('genomicSuperDups', 20, 8000),
+    ('dgv_Cnv', 20, 30000), ('abParts_IG_T_CelReceptors', 5, 10000),
+    ('mcCarroll_Cnv', 10, 10000), ('conrad_Cnv', 10, 10000),
+    ('tfbsConsSites', 10, 40)]
+GENE_DENSITY = 15
+CYTOBAND_SIZE = 1000000
+
+# Rows inserted per statement
+INSERT_SIZE = 10000
+
+
+"""MySQL statements of the stages rewritten for SQLite
+   (parameter style, and the indexes declared inside CREATE TABLE)
+"""
+def translate(sql):
+    sql = sql.replace('%s', '?')
+    return re.sub(r',\s*key \([^)]*\)', '', sql, flags=re.IGNORECASE)
+
+
+"""Cursor with the subset of the pymysql cursor API used by the stages
+"""
+class Cursor(object):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, args=None):
+        if args is None:
+            return self.cursor.execute(translate(sql))
+        return self.cursor.execute(translate(sql), args)
+
+    def executemany(self, sql, args):
+        return self.cursor.executemany(translate(sql), args)
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return tuple(row) if row is not None else None
+
+    def fetchmany(self, size=1):
+        return [tuple(row) for row in self.cursor.fetchmany(size)]
+
+    def fetchall(self):
+        return [tuple(row) for row in self.cursor.fetchall()]
+
+    def __iter__(self):
+        return (tuple(row) for row in self.cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def close(self):
+        self.cursor.close()
+
+
+"""Connection with the subset of the pymysql connection API used by the
+   stages and utils.get_db_connection
+"""
+class Connection(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, cursor_class=None):
+        return Cursor(self.conn.cursor())
+
+    def ping(self, reconnect=False):
+        self.conn.execute('select 1')
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+
+def connect(path):
+    if not os.path.exists(path):
+        raise ValueError(f"Reference stand-in '{path}' does not exist")
+    return Connection(path)
+
+
+"""Creates the empty reference tables and their indexes in a new file
+   Text columns compare case-insensitively, as with the MySQL collation
+"""
+def create(path):
+    if os.path.exists(path):
+        raise ValueError(f"Reference stand-in '{path}' already exists")
+    conn = sqlite3.connect(path)
+    for (table, chrom, start, end) in bn.BUNDLE_TABLES:
+        conn.execute('create table ' + table + ' (' + ', '.join([name + ' ' + \
+            type + (' collate nocase' if type == 'text' else '')
+            for (name, type) in SCHEMAS[table]]) + ')')
+        conn.execute('create index ' + table + '_pos on ' + table + \
+            ' (' + chrom + ', ' + start + ')')
+        if (SCHEMAS[table][0][0] == 'bin'):
+            conn.execute('create index ' + table + '_bin on ' + table + \
+                ' (' + chrom + ', bin)')
+    conn.commit()
+    return conn
+
+
+def insert(conn, table, rows):
+    for i in range(0, len(rows), INSERT_SIZE):
+        conn.executemany('insert into ' + table + ' values (' + \
+            ','.join(['?'] * len(SCHEMAS[table])) + ')',
+            rows[i:i + INSERT_SIZE])
+
+
+"""Variants (chrom, pos, ref, alt) of VCF files, chromosomes without chr
+"""
+def readVariants(vcfs):
+    variants = []
+    for vcf in vcfs:
+        fh = bgzf.openText(vcf)
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            if (len(fields) > 4) and fields[1].strip().isdigit():
+                chrom = fields[0].strip()
+                if chrom.startswith('chr'):
+                    chrom = chrom[len('chr'):]
+                variants.append((chrom, int(fields[1]), fields[3], fields[4]))
+        fh.close()
+    return variants
+
+
+def getRefGeneRow(rnd, id, chrom, start, end, ref, alt):
+    return (id, chrom, start, end, ref, alt, 'NM_' + str(rnd.randint(1, 500)),
+        'G' + str(rnd.randint(1, 50)), rnd.choice('+-'),
+        rnd.choice(['CDS', 'intron', 'utr5', 'utr3', 'non_coding_exon',
+            'non_coding_intron']),
+        str(rnd.randint(0, 2)), str(rnd.randint(1, 900)), '0',
+        rnd.choice(['0', '12', '-3']), 'ACG', 'T', 'AGG', 'R',
+        rnd.choice(['Y', 'N']), rnd.choice(['missense', 'silent', '']),
+        'c.' + str(rnd.randint(1, 99)) + 'A>G', 'p.' + str(rnd.randint(1, 99)),
+        'Y', '', '0')
+
+
+def getIntervalRow(rnd, table, n, chrom, start, end):
+    bin = bi.binFromRange(start, end)
+    if (table == 'gadAll'):
+        return (n, chrom, start, end, rnd.choice(['BRCA1', 'TP53', 'APOE']))
+    if (table == 'targetScanS') or table.startswith('tfbsConsSites'):
+        return (bin, 'chr' + chrom, start, end,
+            rnd.choice(['miR-', 'V$TF']) + str(rnd.randint(1, 300)),
+            rnd.randint(1, 999), rnd.choice('+-'))
+    if (table == 'hugo'):
+        return (bin, 'chr' + chrom, start, end, 'h',
+            'SYM' + str(rnd.randint(1, 30)),
+            rnd.choice(['kinase; putative', 'receptor']))
+    if (table == 'genomicSuperDups'):
+        return (bin, 'chr' + chrom, start, end, 'dup', 0, rnd.choice('+-'),
+            'chr' + str(rnd.randint(1, 22)), rnd.randint(1, 1000000),
+            rnd.randint(1000000, 2000000))
+    return (bin, 'chr' + chrom, start, end, 'cnv')
+
+
+"""Gene model with exons between txStart and txEnd, and the CpG islands at
+   its ends
+"""
+def getGeneRows(rnd, n, chrom, center):
+    tx_start = max(1, center - rnd.randint(0, 5000))
+    tx_end = tx_start + rnd.randint(100, 20000)
+    cuts = sorted(rnd.sample(range(tx_start, tx_end),
+        min(2 * rnd.randint(1, 30), tx_end - tx_start)))
+    exons = list(zip(cuts[0::2], cuts[1::2]))
+    if (rnd.random() < 0.2):
+        (cds_start, cds_end) = (tx_end, tx_end)
+    else:
+        (cds_start, cds_end) = (tx_start + rnd.randint(0, 200),
+            tx_end - rnd.randint(0, 200))
+    gene = (bi.binFromRange(tx_start, tx_end), 'NM_' + str(n), 'chr' + chrom,
+        rnd.choice('+-'), tx_start, tx_end, cds_start, cds_end, len(exons),
+        (''.join([str(s) + ',' for (s, e) in exons])).encode('utf-8'),
+        (''.join([str(e) + ',' for (s, e) in exons])).encode('utf-8'),
+        0, 'GENE' + str(rnd.randint(1, 40)), 'cmpl', 'cmpl', b'0,')
+
+    islands = []
+    if (rnd.random() < 0.7):
+        for (start, end) in [(tx_start - rnd.randint(0, 600),
+            tx_start + rnd.randint(0, 300)), (tx_end - rnd.randint(0, 300),
+            tx_end + rnd.randint(0, 600))]:
+            islands.append((bi.binFromRange(start, end), 'chr' + chrom,
+                start, end, 'CpG: ' + str(rnd.randint(10, 200))))
+    return (gene, islands)
+
+
+"""Generates reference tables around the variants of vcfs, so a share of
+   the variants is found in every table (see the *_RATE and *_DENSITY
+   settings)
+"""
+def generate(path, vcfs, seed=SEED):
+    rnd = random.Random(seed)
+    variants = readVariants(vcfs)
+    conn = create(path)
+    rows = dict((table, []) for table in SCHEMAS)
+    complement = {'A': 'T', 'T': 'A', 'G': 'C', 'C': 'G'}
+
+    for (n, (chrom, pos, ref, alt)) in enumerate(variants):
+        if (rnd.random() < DBSNP_RATE):
+            for i in range(rnd.randint(1, 2)):
+                rows['dbSNP'].append((chrom, pos,
+                    rnd.choice([ref, complement.get(ref, ref)]),
+                    'rs' + str(rnd.randint(1, 10000000)), alt, '.', '.',
+                    rnd.choice(['.', '0.' + str(rnd.randint(1, 500))]),
+                    rnd.choice(['SNV', 'SNV', 'DIV'])))
+
+        x = rnd.random()
+        for (table, rate) in REFGENE_RATES:
+            if (x < rate):
+                if (table == 'chrom_pos_equal_base'):
+                    for i in range(rnd.randint(1, 3)):
+                        rows[table].append(getRefGeneRow(rnd, n, chrom, pos,
+                            pos, ref, alt))
+                elif (table == 'chrom_pos_equal_nobase'):
+                    rows[table].append(getRefGeneRow(rnd, n, chrom, pos, pos,
+                        '', ''))
+                else:
+                    start = pos - rnd.randint(0, 30)
+                    rows[table].append(getRefGeneRow(rnd, n, chrom, start,
+                        start + rnd.randint(0, 60), '', ''))
+                break
+            x = x - rate
+
+        if (rnd.random() < GWAS_RATE):
+            rows['gwasCatalog'].append((bi.binFromRange(pos - 1, pos),
+                'chr' + chrom, pos - 1, pos, 'rs' + str(rnd.randint(1, 10000000)),
+                str(rnd.randint(1, 99999)), 'A', '2010', 'J', 'T',
+                rnd.choice(['Height', 'BMI', "Crohn's"])))
+
+    chroms = {}
+    for (chrom, pos, ref, alt) in variants:
+        chroms.setdefault(chrom, []).append(pos)
+    for chrom in sorted(chroms):
+        positions = sorted(chroms[chrom])
+        for i in range(max(3, len(positions) // GENE_DENSITY)):
+            (gene, islands) = getGeneRows(rnd, len(rows['refGene']), chrom,
+                rnd.choice(positions))
+            rows['refGene'].append(gene)
+            rows['cpgIslandExt'].extend(islands)
+
+        for start in range(0, positions[-1] + 1, CYTOBAND_SIZE):
+            rows['cytoBand'].append(('chr' + chrom, start,
+                start + CYTOBAND_SIZE, rnd.choice(['p11.1', 'q21', 'p36.33']),
+                'gneg'))
+
+        for (table, density, width) in INTERVAL_DENSITY:
+            if (table == 'tfbsConsSites'):
+                table = table + chrom
+                if table not in rows:
+                    continue
+            for i in range(max(2, len(positions) // density)):
+                start = max(0, rnd.choice(positions) - rnd.randint(0, width))
+                rows[table].append(getIntervalRow(rnd, table, i, chrom,
+                    start, start + rnd.randint(1, width)))
+
+    for table in SCHEMAS:
+        insert(conn, table, rows[table])
+        print(f"{table}: {len(rows[table])} rows")
+    conn.commit()
+    conn.close()
+
+
+"""Copies the rows of the reference database in a region into a new
+   stand-in, e.g. to benchmark on real data with a VCF of that region
+"""
+def sample(path, region):
+    import utils as u
+
+    (chrom, _, span) = region.partition(':')
+    (start, _, end) = span.partition('-')
+    chrom = chrom[len('chr'):] if chrom.startswith('chr') else chrom
+    (start, end) = (int(start or 0), int(end or 1 << 31))
+
+    src = u.db_connect()
+    conn = create(path)
+    for (table, chrom_column, start_column, end_column) in bn.BUNDLE_TABLES:
+        if table.startswith('tfbsConsSites') and \
+            (table != 'tfbsConsSites' + chrom):
+            continue
+        cursor = src.cursor()
+        cursor.execute('select ' + ', '.join([name
+            for (name, type) in SCHEMAS[table]]) + ' from ' + table + \
+            ' where ' + chrom_column + ' in (%s, %s) AND ' + \
+            start_column + ' <= %s AND ' + end_column + ' >= %s',
+            (chrom, 'chr' + chrom, end, start))
+        rows = cursor.fetchall()
+        cursor.close()
+        insert(conn, table, rows)
+        print(f"{table}: {len(rows)} rows")
+    conn.commit()
+    conn.close()
+    src.close()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 3 and sys.argv[1] == 'generate'):
+        generate(sys.argv[2], sys.argv[3:])
+    elif (len(sys.argv) == 4 and sys.argv[1] == 'sample'):
+        sample(sys.argv[2], sys.argv[3])
+    else:
+        print("Usage: python localdb.py generate <db_file> <vcf> [vcf ...]\n" + \
+            "       python localdb.py sample <db_file> <chrom:start-end>")
+
+### EOF
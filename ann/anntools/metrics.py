@@ -0,0 +1,240 @@
+# metrics.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Pipeline instrumentation for AnnTools
+#
+# Records, for every stage, the time spent annotating, the lines it
+# processed and, through a cursor wrapper, the number of SQL queries, the
+# rows fetched and the latency distribution of cursor.execute per table.
+# Latencies go to fixed log-scale histograms, so the memory used does not
+# grow with the number of queries and the histograms of the shards of a
+# job can be summed. The result is written as a JSON sidecar of the
+# .count.log file.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import re
+import json
+import math
+import time
+import threading
+
+# Histogram buckets: MIN_LATENCY seconds and up, each BUCKET_GROWTH times
+# wider than the one before (about 5% resolution)
+MIN_LATENCY = 0.000001
+BUCKET_GROWTH = 1.05
+PERCENTILES = [50, 95, 99]
+
+# Table a statement works on: the last one it names
+TABLE_PATTERN = re.compile(
+    r'\b(?:from|join|into|table(?:\s+if\s+not\s+exists)?)\s+`?(\w+)',
+    re.IGNORECASE)
+
+
+"""Table read or written by an SQL statement, '' if none is named
+"""
+def getTable(sql):
+    tables = TABLE_PATTERN.findall(sql)
+    return tables[-1] if (len(tables) > 0) else ''
+
+
+def getBucket(latency):
+    if (latency <= MIN_LATENCY):
+        return 0
+    return int(math.log(latency / MIN_LATENCY) / math.log(BUCKET_GROWTH)) + 1
+
+
+"""Upper bound of the latencies counted in a bucket
+"""
+def getBucketLatency(bucket):
+    return MIN_LATENCY * (BUCKET_GROWTH ** bucket)
+
+
+"""Query counters and latency histogram of one table
+"""
+class TableMetrics(object):
+
+    def __init__(self):
+        self.queries = 0
+        self.rows = 0
+        self.time = 0.0
+        self.histogram = {}
+
+    def addQuery(self, latency):
+        self.queries = self.queries + 1
+        self.time = self.time + latency
+        bucket = getBucket(latency)
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    """Latency below which pct percent of the queries completed
+    """
+    def getPercentile(self, pct):
+        rank = max(1, int(math.ceil(self.queries * pct / 100.0)))
+        count = 0
+        for bucket in sorted(self.histogram):
+            count = count + self.histogram[bucket]
+            if (count >= rank):
+                return getBucketLatency(bucket)
+        return 0.0
+
+    def add(self, other):
+        self.queries = self.queries + other.queries
+        self.rows = self.rows + other.rows
+        self.time = self.time + other.time
+        for (bucket, count) in other.histogram.items():
+            self.histogram[bucket] = self.histogram.get(bucket, 0) + count
+
+    def getSummary(self):
+        summary = {'queries': self.queries, 'rows': self.rows,
+            'time': round(self.time, 6)}
+        for pct in PERCENTILES:
+            summary['p' + str(pct) + '_ms'] = \
+                round(1000 * self.getPercentile(pct), 3)
+        return summary
+
+
+"""Metrics of one stage
+"""
+class StageMetrics(object):
+
+    def __init__(self):
+        self.time = 0.0
+        self.lines = 0
+        self.tables = {}
+
+    def getTable(self, table):
+        if table not in self.tables:
+            self.tables[table] = TableMetrics()
+        return self.tables[table]
+
+    def add(self, other):
+        self.time = self.time + other.time
+        self.lines = self.lines + other.lines
+        for (table, table_metrics) in other.tables.items():
+            self.getTable(table).add(table_metrics)
+
+    def getSummary(self):
+        queries = sum([t.queries for t in self.tables.values()])
+        return {'time': round(self.time, 6), 'lines': self.lines,
+            'queries': queries,
+            'rows': sum([t.rows for t in self.tables.values()]),
+            'queries_per_sec': round(queries / self.time, 1) \
+                if (self.time > 0) else 0.0,
+            'tables': dict((table, self.tables[table].getSummary())
+                for table in sorted(self.tables))}
+
+
+"""Metrics of a job, by stage name in the order the stages were seen
+   Updated from the engine and pool threads, so every update takes a lock
+"""
+class Metrics(object):
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start = time.time()
+
+    def getStage(self, name):
+        if name not in self.stages:
+            self.stages[name] = StageMetrics()
+        return self.stages[name]
+
+    def addTime(self, name, seconds, lines=0):
+        with self.lock:
+            stage = self.getStage(name)
+            stage.time = stage.time + seconds
+            stage.lines = stage.lines + lines
+
+    def addQuery(self, name, table, latency):
+        with self.lock:
+            self.getStage(name).getTable(table).addQuery(latency)
+
+    def addRows(self, name, table, rows):
+        with self.lock:
+            table_metrics = self.getStage(name).getTable(table)
+            table_metrics.rows = table_metrics.rows + rows
+
+    """Adds the metrics of a run on another part of the input, e.g. a
+       shard run in another process
+    """
+    def add(self, other):
+        with self.lock:
+            for (name, stage) in other.stages.items():
+                self.getStage(name).add(stage)
+
+    """Wraps cursor so its queries are recorded for stage name
+    """
+    def wrap(self, cursor, name):
+        return TimedCursor(cursor, self, name)
+
+    def getSummary(self):
+        return {'wall_time': round(time.time() - self.start, 3),
+            'lines': max([s.lines for s in self.stages.values()] or [0]),
+            'stages': dict((name, stage.getSummary())
+                for (name, stage) in self.stages.items())}
+
+    def write(self, filename):
+        with open(filename, 'w') as fh:
+            json.dump(self.getSummary(), fh, indent=1)
+
+    def __getstate__(self):
+        return {'stages': self.stages, 'start': self.start}
+
+    def __setstate__(self, state):
+        self.stages = state['stages']
+        self.start = state['start']
+        self.lock = threading.Lock()
+
+
+"""Cursor recording the latency of its statements and the rows fetched
+   Everything else is passed on to the wrapped cursor
+"""
+class TimedCursor(object):
+
+    def __init__(self, cursor, metrics, name):
+        self.cursor = cursor
+        self.metrics = metrics
+        self.name = name
+        self.table = ''
+
+    def execute(self, sql, args=None):
+        self.table = getTable(sql)
+        t = time.perf_counter()
+        result = self.cursor.execute(sql, args)
+        self.metrics.addQuery(self.name, self.table, time.perf_counter() - t)
+        return result
+
+    def executemany(self, sql, args):
+        self.table = getTable(sql)
+        t = time.perf_counter()
+        result = self.cursor.executemany(sql, args)
+        self.metrics.addQuery(self.name, self.table, time.perf_counter() - t)
+        return result
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.metrics.addRows(self.name, self.table, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.cursor.fetchmany(size) if size else \
+            self.cursor.fetchmany()
+        self.metrics.addRows(self.name, self.table, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.metrics.addRows(self.name, self.table, len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+### EOF
@@ -0,0 +1,228 @@
+# prefilter.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Lookup prefilters for AnnTools
+#
+# Most variants are not in dbSNP or in sparse tables like gwasCatalog and
+# gadAll, but finding that out costs a query each. The build tool writes a
+# Bloom filter of the (chromosome, position) keys of the tables looked up by
+# exact position (dbSNP, gwasCatalog) and, for interval tables, one bitmap
+# per chromosome with a bit for every BIN_SIZE positions covered by a row.
+# A lookup is skipped when the filter says the table has nothing at the
+# position; false positives only cost the query.
+# The filters must be rebuilt whenever the reference tables change.
+#
+# Usage:
+#   python prefilter.py build <filter_dir> [table ...]
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import sys
+import json
+import mmap
+import time
+import shutil
+import hashlib
+import bundle as bn
+
+# Bumped whenever the on-disk layout changes
+PREFILTER_FORMAT = 1
+MANIFEST = 'MANIFEST.json'
+
+# Tables filtered by default. Tables looked up by exact position (see
+# bundle.BUNDLE_TABLES) get a Bloom filter, interval tables get bitmaps
+PREFILTER_TABLES = ['dbSNP', 'gwasCatalog', 'gadAll']
+
+# Bloom filter bits per key (10 bits and 7 hashes give about 1% false
+# positives)
+BLOOM_BITS = 10
+BLOOM_HASHES = 7
+# Positions per bitmap bit
+BIN_SIZE = 64
+
+
+"""Bit positions of a key in a Bloom filter of nbits bits
+   (double hashing of a 128 bit digest)
+"""
+def getBloomBits(key, nbits, nhashes):
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], 'little')
+    h2 = int.from_bytes(digest[8:], 'little') | 1
+    return [(h1 + i * h2) % nbits for i in range(nhashes)]
+
+
+def getBloomKey(chrom, pos):
+    return bn.chromKey(chrom) + ':' + str(int(pos))
+
+
+def testBit(bits, n):
+    return (bits[n >> 3] >> (n & 7)) & 1
+
+
+def setBit(bits, n):
+    bits[n >> 3] = bits[n >> 3] | (1 << (n & 7))
+
+
+"""Builds the Bloom filter of the (chrom, start) keys of a table
+"""
+def buildBloom(conn, cursor_class, path, table, chrom, start):
+    cursor = conn.cursor()
+    cursor.execute('select count(*) from ' + table + ' where ' + start + \
+        ' is not null;')
+    nkeys = cursor.fetchone()[0]
+    cursor.close()
+
+    nbits = max(8, nkeys * BLOOM_BITS)
+    bits = bytearray((nbits + 7) // 8)
+    cursor = conn.cursor(cursor_class)
+    cursor.execute('select ' + chrom + ', ' + start + ' from ' + table + \
+        ' where ' + start + ' is not null;')
+    for row in cursor:
+        for n in getBloomBits(getBloomKey(row[0], row[1]), nbits,
+            BLOOM_HASHES):
+            setBit(bits, n)
+    cursor.close()
+
+    with open(os.path.join(path, table + '.bloom'), 'wb') as fh:
+        fh.write(bits)
+    print(f"{table}: {nkeys} keys in a {len(bits)} byte Bloom filter")
+    return {'kind': 'bloom', 'bits': nbits, 'hashes': BLOOM_HASHES}
+
+
+"""Builds one bitmap of covered positions per chromosome of a table
+"""
+def buildBitmaps(conn, cursor_class, path, table, chrom, start, end):
+    bitmaps = {}
+    cursor = conn.cursor(cursor_class)
+    cursor.execute('select ' + chrom + ', ' + start + ', ' + end + \
+        ' from ' + table + ' where ' + start + ' is not null AND ' + end + \
+        ' is not null;')
+    for row in cursor:
+        bits = bitmaps.setdefault(bn.chromKey(row[0]), bytearray())
+        last = int(row[2]) // BIN_SIZE
+        if (last >= len(bits) * 8):
+            bits.extend(bytearray(last // 8 + 1 - len(bits)))
+        for n in range(max(0, int(row[1])) // BIN_SIZE, last + 1):
+            setBit(bits, n)
+    cursor.close()
+
+    os.makedirs(os.path.join(path, table))
+    spec = {'kind': 'bitmap', 'bin': BIN_SIZE, 'chroms': {}}
+    for (n, c) in enumerate(sorted(bitmaps)):
+        with open(os.path.join(path, table, str(n) + '.bits'), 'wb') as fh:
+            fh.write(bitmaps[c])
+        spec['chroms'][c] = str(n)
+    print(f"{table}: {len(bitmaps)} chromosome bitmaps")
+    return spec
+
+
+"""Builds the filters of tables into a new filter directory, replacing
+   the previous filters once complete
+"""
+def build(path, tables=None):
+    import pymysql
+    import utils as u
+
+    if tables is None:
+        tables = PREFILTER_TABLES
+    specs = dict((t[0], t) for t in bn.BUNDLE_TABLES)
+
+    tmppath = path + '.tmp'
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(tmppath)
+
+    conn = u.db_connect()
+    manifest = {'format': PREFILTER_FORMAT, 'created': int(time.time()),
+        'tables': {}}
+    for table in tables:
+        (table, chrom, start, end) = specs[table]
+        if (start == end):
+            spec = buildBloom(conn, pymysql.cursors.SSCursor, tmppath,
+                table, chrom, start)
+        else:
+            spec = buildBitmaps(conn, pymysql.cursors.SSCursor, tmppath,
+                table, chrom, start, end)
+        manifest['tables'][table] = spec
+    conn.close()
+
+    with open(os.path.join(tmppath, MANIFEST), 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmppath, path)
+
+
+"""Maps a filter file in memory, empty files map to an empty string
+"""
+def mapFile(filename):
+    with open(filename, 'rb') as fh:
+        if (os.fstat(fh.fileno()).st_size == 0):
+            return b''
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+"""Reader for a filter directory
+"""
+class Prefilter(object):
+
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as fh:
+            self.manifest = json.load(fh)
+        if (self.manifest.get('format') != PREFILTER_FORMAT):
+            raise ValueError(f"Unsupported prefilter format in '{path}'")
+        self.path = path
+        self.files = {}
+
+    def getFile(self, name):
+        if name not in self.files:
+            self.files[name] = mapFile(os.path.join(self.path, name))
+        return self.files[name]
+
+    """False if table has no row at key (chrom, pos); True if it may have
+       one, or if the table or the position are not filtered
+    """
+    def mayMatch(self, table, key):
+        spec = self.manifest['tables'].get(table)
+        if (spec is None) or (key is None) or not key[1].isdigit():
+            return True
+        (chrom, pos) = key
+
+        if (spec['kind'] == 'bloom'):
+            bits = self.getFile(table + '.bloom')
+            return all([testBit(bits, n) for n in getBloomBits(
+                getBloomKey(chrom, pos), spec['bits'], spec['hashes'])])
+
+        name = spec['chroms'].get(bn.chromKey(chrom))
+        if name is None:
+            return False
+        bits = self.getFile(os.path.join(table, name + '.bits'))
+        n = int(pos) // spec['bin']
+        return (n < len(bits) * 8) and testBit(bits, n) == 1
+
+
+"""Prefilter counters of the stages written to the .count.log file,
+   nothing if no lookup was skipped
+"""
+def logLines(stages):
+    lines = []
+    for stage in stages:
+        if (stage.prefilter_skips > 0):
+            lines.append(f"{stage.name}: {str(stage.prefilter_skips)} " + \
+                "lookups skipped\n")
+    if (len(lines) > 0):
+        lines.insert(0, "Prefilter:\n")
+    return lines
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'build'):
+        build(sys.argv[2], sys.argv[3:] or None)
+    else:
+        print("Usage: python prefilter.py build <filter_dir> [table ...]")
+
+### EOF
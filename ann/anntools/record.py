@@ -0,0 +1,149 @@
+# record.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Variant records carried through the stages of the single-pass engine
+#
+# A record is split once when it is read: the columns before INFO are kept
+# as a list, INFO as the ordered list of its ';' separated items, and the
+# chromosome, position and alleles the stages look up are normalized once
+# instead of in every stage. Stages add to INFO item by item and the line
+# is joined again only when it is written out. FORMAT and the genotype
+# columns, which no stage reads, are not split at all: they are carried as
+# the one string that follows INFO, so a cohort VCF with thousands of
+# samples costs about the same per line as a sites-only one.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import annotate as ann
+
+# Column of the INFO field
+INFO_COLUMN = 7
+
+
+"""One input line; inds are the format specific indices of the chromosome,
+   position, reference and alternate columns
+   fields holds the columns before INFO, info the INFO items (None if the
+   line has no INFO column) and samples the unsplit rest of the line after
+   INFO (FORMAT and the genotypes), None if there is none
+"""
+class VariantRecord(object):
+    __slots__ = ['fields', 'info', 'samples', 'inds', 'sep', 'tabbed',
+        'chrom', 'chrom_bare', 'pos', 'ref', 'alt']
+
+    def __init__(self, line, inds, sep='\t'):
+        self.inds = inds
+        self.sep = sep
+        self.parse(line)
+
+    def parse(self, line):
+        columns = line.split(self.sep, INFO_COLUMN + 1)
+        self.fields = columns[:INFO_COLUMN]
+        self.info = None
+        if (len(columns) > INFO_COLUMN):
+            self.info = columns[INFO_COLUMN].split(';')
+        self.samples = None
+        if (len(columns) > INFO_COLUMN + 1):
+            self.samples = columns[INFO_COLUMN + 1]
+        self.tabbed = False
+        self.decode()
+
+    """Normalizes the looked up columns the way the stages query them:
+       the chromosome with and without its 'chr' prefix, the position and
+       the alleles stripped and cleaned of quotes
+    """
+    def decode(self):
+        inds = self.inds
+        chr = self.fields[inds[0]].strip()
+        if chr.startswith('chr'):
+            self.chrom = chr
+            self.chrom_bare = chr.replace('chr', '')
+        else:
+            self.chrom = 'chr' + chr
+            self.chrom_bare = chr
+        self.pos = self.fields[inds[1]].strip()
+        self.ref = ann.clean_mysql_chars(self.fields[inds[2]]).strip()
+        self.alt = ann.clean_mysql_chars(self.fields[inds[3]]).strip()
+
+    """Sets one of the columns before INFO
+    """
+    def setField(self, column, value):
+        self.fields[column] = value
+        if column in self.inds:
+            self.decode()
+
+    def getInfo(self):
+        return ';'.join(self.info)
+
+    def setInfo(self, info):
+        self.info = info.split(';')
+        self.tabbed = self.tabbed or (self.sep in info)
+
+    """Same as adding ';' + info to the INFO field
+    """
+    def appendInfo(self, info):
+        self.info.extend(info.split(';'))
+        self.tabbed = self.tabbed or (self.sep in info)
+
+    """Same as adding info to the INFO field, without a separator
+    """
+    def extendInfo(self, info):
+        items = info.split(';')
+        self.info[-1] = self.info[-1] + items[0]
+        self.info.extend(items[1:])
+        self.tabbed = self.tabbed or (self.sep in info)
+
+    """True if the INFO field ends with ';'
+    """
+    def isInfoTerminated(self):
+        return (len(self.info) > 1) and (self.info[-1] == '')
+
+    """Prefixes all columns but the first with prefix
+    """
+    def prefixFields(self, prefix):
+        self.fields[1:] = [prefix + f for f in self.fields[1:]]
+        if self.info is not None:
+            self.info[0] = prefix + self.info[0]
+        if self.samples is not None:
+            self.samples = prefix + self.samples.replace(self.sep,
+                self.sep + prefix)
+
+    """Reproduces the strip() each annotate.py stage applies to the lines it
+       reads. Only needed when a stage left whitespace at either end of the
+       line or put a tab inside the INFO field.
+    """
+    def restrip(self):
+        first = self.fields[0]
+        if self.samples is not None:
+            last = self.samples
+        elif self.info is None:
+            last = self.fields[-1]
+        else:
+            last = self.info[-1]
+            if not last and (len(self.info) > 1):
+                last = ';'
+        if (not first or first[0].isspace() or not last or
+            last[-1].isspace() or self.tabbed):
+            self.parse(self.getLine().strip())
+
+    def getLine(self):
+        if self.info is None:
+            return self.sep.join(self.fields)
+        if self.samples is None:
+            return self.sep.join(self.fields + [self.getInfo()])
+        return self.sep.join(self.fields + [self.getInfo(), self.samples])
+
+    """Copy whose columns can be edited independently of the record
+    """
+    def copy(self):
+        record = VariantRecord.__new__(VariantRecord)
+        for name in VariantRecord.__slots__:
+            setattr(record, name, getattr(self, name))
+        record.fields = list(self.fields)
+        if self.info is not None:
+            record.info = list(self.info)
+        return record
+
+### EOF
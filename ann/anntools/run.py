@@ -11,6 +11,9 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import sys
 import time
 import driver
+import engine
+import s3stream
+import checkpoint
 
 import os
 import boto3
@@ -47,27 +50,81 @@ if __name__ == '__main__':
   # Call the AnnTools pipeline
   if len(sys.argv) > 1:
     with Timer():
-      driver.run(sys.argv[1], 'vcf')
-    
-
-      completion_time = int(time.time())
       job_id = sys.argv[2]
       username = sys.argv[3]
       bucket = config['aws']['AwsS3ResultsBucket']
       prefix = config['aws']['AwsS3KeyPrefix']
       complete_prefix = f'{prefix}{username}'
 
+      # stream the annotated file to S3 while it is written
+      sink = None
+      compress = config.getboolean('anntools', 'CompressOutput')
+      result_file = os.path.basename(engine.getAnnotatedFileName(sys.argv[1],
+        compress=compress))
+      if config.getboolean('anntools', 'StreamOutput'):
+        sink = s3stream.S3Upload(bucket, f'{complete_prefix}/{result_file}',
+          client=boto3.client('s3', region_name=config['aws']['AwsRegionName']),
+          partsize=config.getint('anntools', 'OutputPartSizeMB') * 1024 * 1024,
+          threads=config.getint('anntools', 'OutputUploadThreads'))
+
+      # save the progress of the job, so a redelivered job resumes from it
+      job_checkpoint = None
+      if config.getint('anntools', 'CheckpointInterval') > 0:
+        job_checkpoint = checkpoint.Checkpoint(
+          f"s3://{bucket}/{prefix}{config['anntools']['CheckpointPrefix']}{job_id}",
+          interval=config.getint('anntools', 'CheckpointInterval'),
+          client=boto3.client('s3', region_name=config['aws']['AwsRegionName']))
+
+      try:
+        driver.run(sys.argv[1], 'vcf',
+          blocksize=config.getint('anntools', 'BlockSize'),
+          join=config.getboolean('anntools', 'JoinOverlapTables'),
+          sweep=config.getboolean('anntools', 'SweepOverlapTables'),
+          bundle=config['anntools']['ReferenceBundle'],
+          bundle_version=config['anntools']['ReferenceBundleVersion'],
+          threads=config.getint('anntools', 'StageThreads'),
+          processes=config.getint('anntools', 'ShardProcesses'),
+          cache=config['anntools']['AnnotationCache'],
+          cache_version=config['anntools']['AnnotationCacheVersion'],
+          cache_size=config.getint('anntools', 'AnnotationCacheSizeMB') * \
+            1024 * 1024,
+          cache_ttl=config.getint('anntools', 'AnnotationCacheTTL'),
+          prefilter=config['anntools']['Prefilter'],
+          coverage=config['anntools']['CoverageMaps'],
+          bins=config.getboolean('anntools', 'UseBinIndex'),
+          source=sys.argv[4] if len(sys.argv) > 4 else None,
+          source_chunksize=config.getint('anntools', 'InputChunkSizeMB') * \
+            1024 * 1024,
+          source_readahead=config.getint('anntools', 'InputReadAhead'),
+          sink=sink,
+          compress=compress,
+          checkpoint=job_checkpoint,
+          metrics=config.getboolean('anntools', 'PipelineMetrics'))
+      except BaseException:
+        if sink is not None:
+          sink.abort()
+        raise
+    
+
+      completion_time = int(time.time())
+
 
       # upload to S3
       s3 = boto3.client('s3', region_name=config['aws']['AwsRegionName'])
       fileKey = {}
       for file in os.listdir():
         curr_job_id = file.split('~')[0]
-        if (file.endswith('annot.vcf') or file.endswith('vcf.count.log')) and curr_job_id == job_id:
+        if file.endswith(('annot.vcf', 'annot.vcf.gz', 'annot.vcf.gz.tbi', 'vcf.count.log', 'vcf.metrics.json')) and curr_job_id == job_id:
           try:
             key = f'{complete_prefix}/{file}'
-            if file.endswith('annot.vcf'):
+            if file.endswith(('.tbi', '.metrics.json')):
+              # uploaded next to the result and log files
+              pass
+            elif file.endswith(('annot.vcf', 'annot.vcf.gz')):
               fileKey['result'] = key
+              if sink is not None:
+                # already uploaded while annotating
+                continue
             else:
               fileKey['log'] = key
             s3.upload_file(file, bucket, key)
@@ -0,0 +1,244 @@
+# s3stream.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Streaming S3 input and output for AnnTools
+#
+# Reads an S3 object as consecutive ranged GETs of a fixed chunk size. A
+# background thread fetches up to readahead chunks ahead of the reader,
+# so downloading the input overlaps with annotating it and the job does
+# not wait for the whole file to be on local disk.
+#
+# Writes the annotated output as an S3 multipart upload: every part is
+# uploaded on a thread pool as soon as it is full, so the upload overlaps
+# with annotating the rest of the file and only the last part is left to
+# send when the job is done.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import io
+import os
+import queue
+import threading
+import concurrent.futures
+import bgzf
+
+# Bytes fetched per ranged GET
+CHUNK_SIZE = 8 * 1024 * 1024
+# Chunks fetched ahead of the reader
+READ_AHEAD = 4
+# Bytes per uploaded part (S3 requires at least 5 MB for all but the last)
+PART_SIZE = 8 * 1024 * 1024
+MIN_PART_SIZE = 5 * 1024 * 1024
+# Parts uploaded concurrently
+UPLOAD_THREADS = 4
+
+
+"""S3 client for the region the annotator runs in
+"""
+def getClient():
+    import boto3
+    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+    return boto3.client('s3', region_name=AWS_REGION_NAME)
+
+
+"""Splits an s3://bucket/key URL, None if url is not an S3 URL
+"""
+def parseS3Url(url):
+    if not str(url).startswith('s3://'):
+        return None
+    (bucket, _, key) = url[len('s3://'):].partition('/')
+    return (bucket, key)
+
+
+"""Raw stream over an S3 object, fetched in ranged chunks by a read-ahead
+   thread
+"""
+class S3Stream(io.RawIOBase):
+
+    def __init__(self, bucket, key, client=None, chunksize=CHUNK_SIZE,
+        readahead=READ_AHEAD):
+        io.RawIOBase.__init__(self)
+        if client is None:
+            client = getClient()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.chunksize = chunksize
+        self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.chunks = queue.Queue(maxsize=max(1, readahead))
+        self.chunk = b''
+        self.offset = 0
+        self.eof = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.fetch, daemon=True)
+        self.thread.start()
+
+    """Fetches the chunks in order; None marks the end of the object and
+       an exception is handed over to the reader
+    """
+    def fetch(self):
+        try:
+            for start in range(0, self.size, self.chunksize):
+                end = min(start + self.chunksize, self.size) - 1
+                response = self.client.get_object(Bucket=self.bucket,
+                    Key=self.key, Range=f'bytes={start}-{end}')
+                if not self.put(response['Body'].read()):
+                    return
+            self.put(None)
+        except Exception as e:
+            self.put(e)
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while (self.offset >= len(self.chunk)) and not self.eof:
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if chunk is None:
+                self.eof = True
+            else:
+                self.chunk = chunk
+                self.offset = 0
+
+        n = min(len(b), len(self.chunk) - self.offset)
+        b[:n] = self.chunk[self.offset:self.offset + n]
+        self.offset = self.offset + n
+        return n
+
+    def close(self):
+        self.stopped.set()
+        io.RawIOBase.close(self)
+
+
+"""Opens an S3 object for reading text, like open() does for a local file
+   (gzip or BGZF objects are decompressed)
+"""
+def openS3(bucket, key, client=None, chunksize=CHUNK_SIZE,
+    readahead=READ_AHEAD):
+    raw = S3Stream(bucket, key, client=client, chunksize=chunksize,
+        readahead=readahead)
+    return bgzf.openTextStream(io.BufferedReader(raw))
+
+
+"""Output written to an S3 object with a multipart upload (text is
+   encoded as UTF-8)
+   The upload is started with the first full part and completed by
+   close(); abort() discards the parts uploaded so far
+"""
+class S3Upload(object):
+
+    def __init__(self, bucket, key, client=None, partsize=PART_SIZE,
+        threads=UPLOAD_THREADS):
+        if client is None:
+            client = getClient()
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.partsize = max(partsize, MIN_PART_SIZE)
+        self.threads = max(1, threads)
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.threads)
+        self.upload_id = None
+        self.buffer = bytearray()
+        self.futures = []
+        self.closed = False
+
+    def write(self, s):
+        self.buffer.extend(s.encode('utf-8') if isinstance(s, str) else s)
+        if (len(self.buffer) >= self.partsize):
+            self.submit()
+        return len(s)
+
+    """Queues the buffered bytes as the next part, waiting for earlier
+       parts when too many are in flight
+    """
+    def submit(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+        pending = [f for f in self.futures if not f.done()]
+        if (len(pending) >= 2 * self.threads):
+            concurrent.futures.wait(pending,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+        self.futures.append(self.pool.submit(self.uploadPart,
+            len(self.futures) + 1, bytes(self.buffer)))
+        self.buffer = bytearray()
+
+    def uploadPart(self, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, PartNumber=number, Body=data)
+        return {'ETag': response['ETag'], 'PartNumber': number}
+
+    """Uploads the last part and completes the upload
+    """
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if (len(self.buffer) > 0) or (len(self.futures) == 0):
+                self.submit()
+            parts = [f.result() for f in self.futures]
+            self.client.complete_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': parts})
+        except BaseException:
+            self.abort()
+            raise
+        self.closed = True
+        self.pool.shutdown()
+
+    """Stops the upload and deletes its parts, unless it was completed
+    """
+    def abort(self):
+        if self.closed:
+            return
+        self.closed = True
+        for future in self.futures:
+            future.cancel()
+        self.pool.shutdown()
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.upload_id)
+
+
+"""Writes to a local file and to a copy, e.g. an S3Upload
+"""
+class TeeWriter(object):
+
+    def __init__(self, fh, copy):
+        self.fh = fh
+        self.copy = copy
+
+    def write(self, s):
+        self.copy.write(s)
+        return self.fh.write(s)
+
+    def close(self):
+        self.fh.close()
+        self.copy.close()
+
+
+"""Downloads an S3 object to a local file, for the modes that read their
+   input more than once
+"""
+def spool(bucket, key, path, client=None):
+    if client is None:
+        client = getClient()
+    client.download_file(bucket, key, path)
+
+### EOF
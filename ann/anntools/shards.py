@@ -0,0 +1,187 @@
+# shards.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Sharded parallel annotation for AnnTools
+#
+# Splits the records of the input VCF into shards by chromosome (the
+# largest chromosomes are further split into fixed-size position blocks),
+# annotates the shards with the single-pass engine in a process pool and
+# merges the annotated shards back into the original line order. The
+# .count.log counters of the shards are summed, so the output is the same
+# as the one of a single engine run.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import shutil
+import multiprocessing
+import concurrent.futures
+import annotate as ann
+import engine
+import stages as st
+import utils as u
+import binning as bi
+import metrics as mt
+import bgzf
+
+# Chromosomes split into blocks of SHARD_BLOCK_SIZE positions
+SPLIT_CHROMS = ['1', '2']
+SHARD_BLOCK_SIZE = 50000000
+# Records of any further chromosome (unplaced contigs...) share one shard
+MAX_SHARDS = 64
+
+
+"""Shard key of a record: its chromosome, plus the position block for the
+   chromosomes in SPLIT_CHROMS
+"""
+def getShardKey(fields, inds):
+    chr = fields[inds[0]].strip()
+    if chr.startswith("chr"):
+        chr = str(chr).replace("chr", "", 1)
+    pos = fields[inds[1]].strip() if (len(fields) > inds[1]) else ''
+    if (chr in SPLIT_CHROMS) and pos.isdigit():
+        return chr + ':' + str(int(pos) // SHARD_BLOCK_SIZE)
+    return chr
+
+
+"""Maps shard keys to shard numbers in order of first appearance
+"""
+class ShardMap(object):
+
+    def __init__(self, format='vcf', sep='\t'):
+        self.inds = ann.getFormatSpecificIndices(format=format)
+        self.sep = sep
+        self.shards = {}
+
+    def getShard(self, line):
+        key = getShardKey(line.split(self.sep, self.inds[1] + 1), self.inds)
+        if (key not in self.shards) and (len(self.shards) >= MAX_SHARDS - 1):
+            key = None
+        if key not in self.shards:
+            self.shards[key] = len(self.shards)
+        return self.shards[key]
+
+
+"""Name of the file holding shard number n in shard_dir
+"""
+def getShardFileName(shard_dir, n):
+    return os.path.join(shard_dir, 'shard_' + str(n) + '.vcf')
+
+
+"""Writes the records of infile to one file per shard
+   Header lines are left out, they are copied back in by merge()
+"""
+def split(infile, shard_dir, format='vcf', sep='\t'):
+    shard_map = ShardMap(format=format, sep=sep)
+    files = []
+
+    fh = bgzf.openText(infile)
+    for line in fh:
+        line = line.strip()
+        if line.startswith('#'):
+            continue
+        n = shard_map.getShard(line)
+        if n == len(files):
+            files.append(open(getShardFileName(shard_dir, n), 'w'))
+        files[n].write(line + '\n')
+    fh.close()
+
+    for fh_shard in files:
+        fh_shard.close()
+    return len(files)
+
+
+"""Merges the annotated shards back into the line order of infile
+   The shard of each record is recomputed while re-reading infile, and
+   every shard holds its records in input order, so the next line of the
+   record's shard is its annotated line.
+"""
+def merge(infile, shard_dir, outfile, format='vcf', sep='\t', sink=None,
+    compress=False):
+    shard_map = ShardMap(format=format, sep=sep)
+    files = []
+
+    fh = bgzf.openText(infile)
+    fh_out = engine.openOutput(outfile, infile, compress=compress, sink=sink)
+    for line in fh:
+        line = line.strip()
+        if line.startswith('#'):
+            fh_out.write(line + '\n')
+            continue
+        n = shard_map.getShard(line)
+        if n == len(files):
+            files.append(open(engine.getAnnotatedFileName(
+                getShardFileName(shard_dir, n))))
+        fh_out.write(files[n].readline())
+    fh.close()
+    fh_out.close()
+
+    for fh_shard in files:
+        fh_shard.close()
+
+
+"""Annotates one shard in a pool process, returns the stage counters and
+   the shard metrics if collect is set
+"""
+def annotateShard(shard_file, format, options, collect=False):
+    metrics = mt.Metrics() if collect else None
+    stages = engine.run(shard_file, format=format, metrics=metrics, **options)
+    return ([stage.getCounters() for stage in stages], metrics)
+
+
+"""Runs first in each forked worker: drops the database connection and the
+   module caches inherited from the parent process, so that the worker
+   opens a connection of its own instead of sharing the parent's socket
+"""
+def initWorker():
+    u.forget_db_connection()
+    st.cpg_islands = None
+    bi.binned = {}
+
+
+"""Annotates infile with up to processes shards running in parallel
+   options are passed on to engine.run for every shard; sink gets a copy
+   of the merged output, which is compressed if compress is set. The
+   metrics of the shards are added to metrics
+"""
+def run(infile, format='vcf', processes=1, sep='\t', sink=None,
+    compress=False, metrics=None, **options):
+    shard_dir = infile + '.shards'
+    if os.path.exists(shard_dir):
+        shutil.rmtree(shard_dir)
+    os.mkdir(shard_dir)
+
+    nshards = split(infile, shard_dir, format=format, sep=sep)
+    options['sep'] = sep
+
+    stages = st.defaultStages(format=format,
+        join=options.get('join', False), sweep=options.get('sweep', False))
+    # Forked workers keep the hash seed of this process, so the names the
+    # stages join from sets come out in the same order as in a single run
+    context = multiprocessing.get_context('fork')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+        mp_context=context, initializer=initWorker) as pool:
+        futures = [pool.submit(annotateShard, getShardFileName(shard_dir, n),
+            format, options, metrics is not None) for n in range(nshards)]
+        for future in futures:
+            (shard_counters, shard_metrics) = future.result()
+            for (stage, counters) in zip(stages, shard_counters):
+                stage.addCounters(counters)
+            if metrics is not None:
+                metrics.add(shard_metrics)
+
+    merge(infile, shard_dir, infile + '.annot', format=format, sep=sep,
+        sink=sink, compress=compress)
+    engine.writeCountLog(infile, stages)
+    shutil.rmtree(shard_dir)
+    os.rename(infile + '.annot', engine.getAnnotatedFileName(infile,
+        compress=compress))
+
+    for stage in stages:
+        print(f"{stage.name} - done.")
+    return stages
+
+### EOF
@@ -0,0 +1,1265 @@
+# stages.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# In-memory annotation stages used by the single-pass engine (engine.py).
+# Each stage reproduces the per-line logic of the corresponding function in
+# annotate.py, but operates on already split records instead of re-reading
+# and re-writing the whole VCF file.
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import heapq
+import bisect
+import threading
+import collections
+import file_utils as fu
+import utils as u
+import annotate as ann
+import binning as bi
+
+# Keys resolved per query by the batched lookups
+BATCH_SIZE = 2000
+# Records resolved per UNION ALL statement by the batched RefGene lookup,
+# each adds a query to the statement
+UNION_SIZE = 500
+# Transcripts whose parsed exons are kept by GenesStage
+EXON_CACHE_SIZE = 20000
+
+
+"""Compares strings the way the default MySQL collation does
+   (case insensitive, trailing spaces ignored)
+"""
+def collate(value):
+    return str(value).upper().rstrip(' ')
+
+
+"""Base class for an annotation stage
+   Stages annotate blocks of records (record.VariantRecord) in place
+   and keep the counters that are reported in the .count.log file.
+   A block is annotated in two steps: lookup returns the reference rows
+   found for every record and applyFound edits the records with them.
+   When a reference bundle is set the cursor is not used.
+"""
+class Stage(object):
+    name = ''
+    # Reference bundle (bundle.Bundle) answering lookups instead of MySQL
+    bundle = None
+    # Cross-job annotation cache (cache.AnnotationCache)
+    cache = None
+    # Filters ruling out lookups that cannot match (prefilter.Prefilter)
+    prefilter = None
+    # Coverage maps answering the CNV lookups (cnvcoverage.Coverage)
+    coverage = None
+    # Add UCSC bin predicates to the range queries of tables with a bin
+    # column (see binning.py)
+    bins = False
+    # True if the lookup only depends on the chromosome and position of
+    # the records, so it can run before the previous stages are applied
+    independent = False
+    # Attributes holding the counters reported in the .count.log file
+    counters = []
+    # Counters kept for every stage: lookups answered from and missing in
+    # the annotation cache, lookups skipped by the prefilter
+    lookup_counters = ['cache_hits', 'cache_misses', 'prefilter_skips']
+    cache_hits = 0
+    cache_misses = 0
+    prefilter_skips = 0
+
+    def __init__(self, table=None, format='vcf'):
+        self.table = table
+        self.inds = ann.getFormatSpecificIndices(format=format)
+
+    def annotate(self, cursor, records):
+        self.applyFound(records, self.lookupCached(cursor, records))
+
+    """Returns the list of rows found for each record of the block
+    """
+    def lookup(self, cursor, records):
+        return [self.lookupRecord(cursor, record) for record in records]
+
+    def lookupRecord(self, cursor, record):
+        raise NotImplementedError
+
+    """Same as lookup, skipping the records the prefilter rules out and
+       answering the records found in the annotation cache from the cache
+    """
+    def lookupCached(self, cursor, records):
+        candidates = records
+        if self.prefilter is not None:
+            found = [[] for record in records]
+            matches = [i for (i, record) in enumerate(records)
+                if self.prefilter.mayMatch(self.table,
+                    self.getFilterKey(record))]
+            self.prefilter_skips = self.prefilter_skips + len(records) - \
+                len(matches)
+            if (len(matches) < len(records)):
+                candidates = [records[i] for i in matches]
+
+        if self.cache is None:
+            rows = self.lookup(cursor, candidates)
+        else:
+            rows = self.cache.lookup(self, cursor, candidates)
+
+        if candidates is records:
+            return rows
+        for (i, r) in zip(matches, rows):
+            found[i] = r
+        return found
+
+    """Key of the lookup of a record in the annotation cache; the rows
+       found must only depend on it. None if the stage is not cached
+    """
+    def getCacheKey(self, record):
+        return None
+
+    """Options changing which rows the lookups return or their order,
+       added to the cache keys so that a lookup is only answered with rows
+       found in the same mode
+    """
+    def getLookupMode(self):
+        return (self.bundle is not None, self.bins)
+
+    """(chromosome, position) of a record as stored in the stage table,
+       checked against the prefilter. None if the stage is not filtered
+    """
+    def getFilterKey(self, record):
+        return None
+
+    """Bin predicate for a range query on table overlapping [start, end],
+       empty if bins are off or the table has no bin column
+    """
+    def getBinSql(self, cursor, table, start, end):
+        if not self.bins or not bi.hasBinColumn(cursor, table):
+            return ''
+        return bi.getBinSql(start, end)
+
+    def applyFound(self, records, found):
+        for (record, rows) in zip(records, found):
+            self.applyRows(record, rows)
+
+    def applyRows(self, record, rows):
+        raise NotImplementedError
+
+    def logLines(self):
+        return []
+
+    def getCounters(self):
+        return dict((name, getattr(self, name)) for name in
+            self.counters + self.lookup_counters)
+
+    """Adds the counters of the same stage run on another part of the input
+    """
+    def addCounters(self, counters):
+        for name in self.counters + self.lookup_counters:
+            setattr(self, name, getattr(self, name) + counters[name])
+
+
+"""dbSNP lookup, see annotate.getSnpsFromDbSnp
+   With batchsize > 0 the keys of up to batchsize records are resolved
+   with a single query and the rows are fanned back out to the records
+"""
+class DbSnpStage(Stage):
+    name = 'dbSNP'
+    counters = ['var_count', 'linenum']
+
+    def __init__(self, format='vcf', varclass='SNV', batchsize=0):
+        Stage.__init__(self, table='dbSNP', format=format)
+        self.varclass = varclass
+        self.batchsize = batchsize
+        self.var_count = 0
+        self.linenum = 1
+
+    def getKey(self, record):
+        return (record.chrom_bare, record.pos, record.ref,
+            ann.getComplementary(record.ref))
+
+    def getCacheKey(self, record):
+        return self.getKey(record)[:3] + (self.varclass,) + \
+            self.getLookupMode()
+
+    def getLookupMode(self):
+        return Stage.getLookupMode(self) + (self.batchsize > 0,)
+
+    def getFilterKey(self, record):
+        return self.getKey(record)[:2]
+
+    def lookup(self, cursor, records):
+        if (self.batchsize <= 0) or (self.bundle is not None):
+            return Stage.lookup(self, cursor, records)
+
+        found = []
+        for i in range(0, len(records), self.batchsize):
+            found.extend(self.lookupBatch(cursor,
+                records[i:i + self.batchsize]))
+        return found
+
+    def getBundleRows(self, chr, pos, ref, compRef):
+        if not pos.isdigit():
+            return []
+        table = self.bundle.getTable('dbSNP')
+        iref = table.index('REF')
+        iinfo = table.index('INFO')
+        refs = (collate(ref), collate(compRef))
+        return [row for row in table.overlap(chr, int(pos), int(pos))
+            if (collate(row[iref]) in refs) and
+                (collate(row[iinfo]) == collate(self.varclass))]
+
+    def lookupRecord(self, cursor, record):
+        (chr, pos, ref, compRef) = self.getKey(record)
+        if self.bundle is not None:
+            return self.getBundleRows(chr, pos, ref, compRef)
+
+        sql = 'select * from dbSNP where CHR="' + str(chr) + \
+            '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
+            '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
+            self.varclass + '" ;'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def lookupBatch(self, cursor, records):
+        found = []
+        keys = []
+        positions = {}
+        for record in records:
+            key = self.getKey(record)
+            if not key[1].isdigit():
+                # Let MySQL deal with unusual positions, as it always did
+                found.append(self.lookupRecord(cursor, record))
+                keys.append(None)
+                continue
+            found.append(None)
+            keys.append(key)
+            positions.setdefault(key[0], set()).add(int(key[1]))
+
+        rows_by_pos = {}
+        if (len(positions) > 0):
+            # The leading key columns are used to fan the rows out, the
+            # remaining columns are the same row "select *" returns
+            terms = ['(CHR="' + chr + '" AND POS IN (' + \
+                ','.join([str(x) for x in sorted(pos)]) + '))'
+                for (chr, pos) in positions.items()]
+            sql = 'select CHR, POS, REF, dbSNP.* from dbSNP where INFO = "' + \
+                self.varclass + '" AND (' + ' OR '.join(terms) + ');'
+            cursor.execute(sql)
+            for row in cursor.fetchall():
+                k = (collate(row[0]), int(row[1]))
+                rows_by_pos.setdefault(k, []).append(row)
+
+        for (i, key) in enumerate(keys):
+            if key is None:
+                continue
+            refs = (collate(key[2]), collate(key[3]))
+            found[i] = [row[3:] for row in
+                rows_by_pos.get((collate(key[0]), int(key[1])), [])
+                if collate(row[2]) in refs]
+        return found
+
+    def applyRows(self, record, rows):
+        record.setField(2, '.')
+        if (len(rows) > 0):
+            rsids = []
+            mafs = []
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
+
+            maf_str = ''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join(mafs)
+
+            self.var_count = self.var_count + 1
+            if (record.info == ['.']):
+                record.setInfo('DB' + maf_str)
+            else:
+                record.appendInfo('DB;VC=' + self.varclass + maf_str)
+
+            record.setField(2, ';'.join(rsids))
+
+        self.linenum = self.linenum + 1
+
+    def logLines(self):
+        ratioInDbSnp = (self.var_count / float(self.linenum)) * 100
+        return ["## Please notice that all Isoforms were counted\n",
+            "## Numbers may exceed number of variants in the annotated file\n",
+            f"Total: {str(self.linenum)}\n",
+            f"In dbSNP: {str(self.var_count)} ({str(ratioInDbSnp)}%)\n"]
+
+    def addCounters(self, counters):
+        Stage.addCounters(self, counters)
+        # linenum starts at 1 in every run
+        self.linenum = self.linenum - 1
+
+
+"""bigRefGene lookup, see annotate.getBigRefGene
+   NOTE: all isoforms are collapsed in one record
+"""
+class BigRefGeneStage(Stage):
+    name = 'BigRefGene'
+    # Tables queried in order of precedence
+    tables = ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']
+
+    def __init__(self, format='vcf', batchsize=0):
+        Stage.__init__(self, format=format)
+        self.batchsize = batchsize
+
+    def getKey(self, record):
+        return (record.chrom_bare, record.pos, record.ref, record.alt)
+
+    def getCacheKey(self, record):
+        return self.getKey(record) + self.getLookupMode()
+
+    def getLookupMode(self):
+        return Stage.getLookupMode(self) + (self.batchsize > 0,)
+
+    """Conditions of the queries on each of the tables
+    """
+    def getConditions(self, chr, pos, ref, alt):
+        compRef = ann.getComplementary(ref)
+        compAlt = ann.getComplementary(alt)
+        return ['CHR="' + str(chr) + '" AND start = ' + str(pos) + \
+                ' AND ((haplotypeReference="' + str(ref) + \
+                '" AND haplotypeAlternate ="' + str(alt) + \
+                '") OR (haplotypeReference="' + str(compRef) + \
+                '" AND haplotypeAlternate ="' + str(compAlt) + '"))',
+            'CHR="' + str(chr) + '" AND start = ' + str(pos),
+            'CHR="' + str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
+                str(pos) + ' <= end']
+
+    def lookup(self, cursor, records):
+        if (self.batchsize <= 0) or (self.bundle is not None):
+            return Stage.lookup(self, cursor, records)
+
+        found = []
+        for i in range(0, len(records), self.batchsize):
+            found.extend(self.lookupBatch(cursor,
+                records[i:i + self.batchsize]))
+        return found
+
+    def lookupRecord(self, cursor, record):
+        (chr, pos, ref, alt) = self.getKey(record)
+        if self.bundle is not None:
+            return self.getBundleRows(chr, pos, [(ref, alt),
+                (ann.getComplementary(ref), ann.getComplementary(alt))])
+
+        conditions = self.getConditions(chr, pos, ref, alt)
+        for (table, condition) in zip(self.tables, conditions):
+            cursor.execute('select * from ' + table + ' where ' + \
+                condition + ';')
+            rows = cursor.fetchall()
+            if (len(rows) > 0):
+                return rows
+        return []
+
+    """Resolves a block of records with one statement per table: the
+       queries of all records still unresolved are sent as one UNION ALL,
+       each tagged with the record number, so a record only gets the rows
+       of the first table that has any
+    """
+    def lookupBatch(self, cursor, records):
+        found = []
+        pending = []
+        for (i, record) in enumerate(records):
+            key = self.getKey(record)
+            if not key[1].isdigit():
+                # Let MySQL deal with unusual positions, as it always did
+                found.append(self.lookupRecord(cursor, record))
+                continue
+            found.append([])
+            pending.append((i, self.getConditions(*key)))
+
+        for (n, table) in enumerate(self.tables):
+            if (len(pending) == 0):
+                break
+            cursor.execute(' union all '.join(['select ' + str(i) + ', ' + \
+                table + '.* from ' + table + ' where ' + conditions[n]
+                for (i, conditions) in pending]) + ';')
+            for row in cursor.fetchall():
+                found[row[0]].append(row[1:])
+            pending = [(i, conditions) for (i, conditions) in pending
+                if (len(found[i]) == 0)]
+        return found
+
+    """Same precedence as the queries: exact base match, then no-base
+       match, then range overlap
+    """
+    def getBundleRows(self, chr, pos, alleles):
+        if not pos.isdigit():
+            return []
+        pos = int(pos)
+        table = self.bundle.getTable('chrom_pos_equal_base')
+        iref = table.index('haplotypeReference')
+        ialt = table.index('haplotypeAlternate')
+        alleles = [(collate(ref), collate(alt)) for (ref, alt) in alleles]
+        rows = [row for row in table.overlap(chr, pos, pos)
+            if (collate(row[iref]), collate(row[ialt])) in alleles]
+        if (len(rows) > 0):
+            return rows
+
+        for name in ('chrom_pos_equal_nobase', 'chrom_pos_unequal'):
+            rows = self.bundle.getTable(name).overlap(chr, pos, pos)
+            if (len(rows) > 0):
+                return rows
+        return []
+
+    def applyRows(self, record, rows):
+        if (len(rows) == 0):
+            return
+
+        m = set([])
+        for row in rows:
+            m.add(ann.collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+        record.appendInfo(';'.join(m))
+        # Drop the '.' of an empty INFO field
+        if (record.info[0] == '.'):
+            del record.info[0]
+
+
+"""Location in gene structures, see annotate.getGenes
+"""
+class GenesStage(Stage):
+    name = 'Genes'
+    counters = ['interGenic_count', 'cds_count', 'utr3_count', 'utr5_count',
+        'intronic_count', 'non_coding_intronic_count', 'exonic_count',
+        'non_coding_exonic_count', 'promoter_count']
+
+    def __init__(self, format='vcf', table='refGene', promoter_offset=500):
+        Stage.__init__(self, table=table, format=format)
+        self.promoter_offset = promoter_offset
+        self.interGenic_count = 0
+        self.cds_count = 0
+        self.utr3_count = 0
+        self.utr5_count = 0
+        self.intronic_count = 0
+        self.non_coding_intronic_count = 0
+        self.exonic_count = 0
+        self.non_coding_exonic_count = 0
+        self.promoter_count = 0
+        self.exons = collections.OrderedDict()
+
+    """Looks the records up through the annotation cache; the rows are
+       applied with the cursor, which the CpG island index is loaded with
+    """
+    def annotate(self, cursor, records):
+        found = self.lookupCached(cursor, records)
+        for (record, rows) in zip(records, found):
+            self.applyRows(cursor, record, rows)
+
+    def getCacheKey(self, record):
+        return (record.chrom, record.pos, self.promoter_offset) + \
+            self.getLookupMode()
+
+    """refGene rows of the transcripts within promoter_offset of a record
+    """
+    def lookupRecord(self, cursor, record):
+        promoter_offset = self.promoter_offset
+        chr = record.chrom
+        pos = record.pos
+
+        if self.bundle is not None:
+            if not pos.isdigit():
+                return []
+            return self.bundle.getTable(self.table).overlap(chr,
+                int(pos) - int(promoter_offset),
+                int(pos) + int(promoter_offset))
+
+        bins = ''
+        if pos.isdigit():
+            bins = self.getBinSql(cursor, self.table,
+                int(pos) - int(promoter_offset),
+                int(pos) + int(promoter_offset))
+        sql = 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND (txStart - ' + str(promoter_offset) + \
+            ') <= ' + str(pos) + ' AND ' + str(pos) + \
+            ' <= (txEnd + ' + str(promoter_offset) + ')' + bins + \
+            ' order by txStart, txEnd, name;'
+        cursor.execute(sql)
+        return cursor.fetchall()
+
+    def applyRows(self, cursor, record, rows):
+        chr = record.chrom
+        pos = record.pos
+
+        if (len(rows) == 0):
+            record.appendInfo("positionType=interGenic")
+            self.interGenic_count = self.interGenic_count + 1
+            return
+
+        # The position type comes from the INFO field as it was before
+        # this stage, the same for every row
+        positionType = self.getPositionType(record)
+        info = []
+        cnt = 1
+        for row in rows:
+            self.countPositionType(positionType)
+            region = self.getRegion(cursor, chr, int(pos), row)
+            if (region != ''):
+                info.append(ann.collapseGeneNames(row=row,
+                    indices=ann.indicesKnownGenes, region=region, cnt=cnt))
+            cnt = cnt + 1
+
+        record.appendInfo(";".join(info))
+
+    def getPositionType(self, record):
+        info_field = ann.clean_mysql_chars(record.getInfo()).strip()
+        return str(u.parse_field(info_field, 'positionType', ';', '='))
+
+    def countPositionType(self, positionType):
+        if (positionType == 'intron'):
+            self.intronic_count = self.intronic_count + 1
+        elif (positionType == 'non_coding_intron'):
+            self.non_coding_intronic_count = self.non_coding_intronic_count + 1
+        elif (positionType == 'CDS'):
+            self.cds_count = self.cds_count + 1
+        elif (positionType == 'non_coding_exon'):
+            self.non_coding_exonic_count = self.non_coding_exonic_count + 1
+        elif (positionType == 'utr5'):
+            self.utr5_count = self.utr5_count + 1
+        elif (positionType == 'utr3'):
+            self.utr3_count = self.utr3_count + 1
+
+    """Exon index of the transcript of a refGene row, parsed once and kept
+       for the EXON_CACHE_SIZE most recently used transcripts
+    """
+    def getExonIndex(self, row):
+        key = (row[1], row[2], row[4], row[9], row[10])
+        index = self.exons.get(key)
+        if index is None:
+            index = ExonIndex(int(row[8]), str(row[9].decode("utf-8")),
+                str(row[10].decode("utf-8")))
+            self.exons[key] = index
+            if (len(self.exons) > EXON_CACHE_SIZE):
+                self.exons.popitem(last=False)
+        else:
+            self.exons.move_to_end(key)
+        return index
+
+    def getRegion(self, cursor, chr, pos, row):
+        txtStart = int(row[4])
+        txtEnd = int(row[5])
+        cdsStart = int(row[6])
+        cdsEnd = int(row[7])
+        exonCount = int(row[8])
+        strand = str(row[3])
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+
+        if (cdsStart == cdsEnd):
+            exons = []
+            for e in self.getExonIndex(row).find(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+            return ";".join(exons)
+
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            exons = []
+            for e in self.getExonIndex(row).find(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                self.exonic_count = self.exonic_count + 1
+            return ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            island = self.getCpgIsland(cursor, chr, pos)
+            if (island is not None):
+                self.promoter_count = self.promoter_count + 1
+                return 'putativePromoterRegion=' + "".join(str(island[3]).split())
+
+        return ''
+
+    def getCpgIsland(self, cursor, chr, pos):
+        if self.bundle is not None:
+            rows = self.bundle.getTable('cpgIslandExt').overlap(chr, pos, pos,
+                columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+            return rows[0] if len(rows) > 0 else None
+
+        return getCpgIslandIndex(cursor).getIsland(chr, pos)
+
+    def logLines(self):
+        return ["Variants located:\n",
+            f"In interGenic {str(self.interGenic_count)}\n",
+            f"In CDS {str(self.cds_count)}\n",
+            f"In \'3 UTR {str(self.utr3_count)}\n",
+            f"In \'5 UTR {str(self.utr5_count)}\n",
+            f"In Intronic {str(self.intronic_count)}\n",
+            f"In Non_coding_intronic {str(self.non_coding_intronic_count)}\n",
+            f"In Exonic {str(self.exonic_count)}\n",
+            f"In Non_coding_exonic {str(self.non_coding_exonic_count)}\n",
+            f"In Putative Promoter Region {str(self.promoter_count)}\n"]
+
+
+"""Intervals sorted by start, with the running maximum of their ends, so
+   the intervals containing a position are found with bisect
+"""
+class IntervalIndex(object):
+
+    def __init__(self, intervals):
+        intervals = sorted(intervals)
+        self.starts = [interval[0] for interval in intervals]
+        self.ends = [interval[1] for interval in intervals]
+        self.values = [interval[2] for interval in intervals]
+        self.maxends = []
+        maxend = None
+        for end in self.ends:
+            maxend = end if maxend is None else max(maxend, end)
+            self.maxends.append(maxend)
+
+    """Sorted values of the intervals with start <= pos <= end
+    """
+    def find(self, pos):
+        found = []
+        i = bisect.bisect_right(self.starts, pos) - 1
+        while (i >= 0) and (self.maxends[i] >= pos):
+            if (self.ends[i] >= pos):
+                found.append(self.values[i])
+            i = i - 1
+        found.sort()
+        return found
+
+
+"""Exons of a transcript; find returns the numbers (0 based, in
+   transcript order) of the exons containing a position
+"""
+class ExonIndex(IntervalIndex):
+
+    def __init__(self, exonCount, exonStarts, exonEnds):
+        exonsSt = exonStarts.split(',')
+        exonsEn = exonEnds.split(',')
+        IntervalIndex.__init__(self, [(int(exonsSt[e]), int(exonsEn[e]), e)
+            for e in range(0, exonCount)])
+
+
+"""cpgIslandExt held in memory, one IntervalIndex per chromosome
+   getIsland returns the (chrom, chromStart, chromEnd, name) row the
+   per-variant query would fetch first: the overlapping island with the
+   lowest start, end and name
+"""
+class CpgIslandIndex(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+        chroms = {}
+        for (n, row) in enumerate(rows):
+            chroms.setdefault(collate(row[0]), []).append(
+                (int(row[1]), int(row[2]), n))
+        self.chroms = dict((chr, IntervalIndex(intervals))
+            for (chr, intervals) in chroms.items())
+
+    def getIsland(self, chr, pos):
+        index = self.chroms.get(collate(chr))
+        if index is None:
+            return None
+        found = index.find(pos)
+        return self.rows[found[0]] if (len(found) > 0) else None
+
+
+# cpgIslandExt index, loaded once per process by getCpgIslandIndex
+cpg_islands = None
+cpg_islands_lock = threading.Lock()
+
+
+"""Loads cpgIslandExt (about 30k rows) into a CpgIslandIndex the first
+   time it is needed in the process
+"""
+def getCpgIslandIndex(cursor):
+    global cpg_islands
+    with cpg_islands_lock:
+        if cpg_islands is None:
+            cursor.execute('select chrom, chromStart, chromEnd, name from ' + \
+                'cpgIslandExt where chromStart is not null AND ' + \
+                'chromEnd is not null order by chromStart, chromEnd, name;')
+            cpg_islands = CpgIslandIndex(cursor.fetchall())
+    return cpg_islands
+
+
+"""Session temporary table holding the (chrom, pos) pairs of a block
+   Shared by the overlap stages running in join mode; it is loaded once
+   per block and every table is then annotated with a single range JOIN.
+   Temporary tables are private to a connection, so stages running on
+   other threads (each with its own connection) load their own copy
+"""
+class VariantTable(object):
+    name = 'job_variants'
+
+    def __init__(self):
+        self.state = threading.local()
+
+    def load(self, cursor, records):
+        # Reload the block if the connection is replaced (utils.RetryCursor)
+        if hasattr(cursor, 'onReconnect'):
+            cursor.onReconnect(self.reload)
+        if records is getattr(self.state, 'records', None):
+            return self.state.loaded
+
+        values = []
+        loaded = []
+        for (linenum, record) in enumerate(records):
+            pos = record.pos
+            # Unusual positions are left to the per-variant queries
+            loaded.append(pos.isdigit())
+            if pos.isdigit():
+                values.append((linenum, record.chrom, record.chrom_bare,
+                    int(pos)))
+
+        self.state.records = records
+        self.state.values = values
+        self.state.loaded = loaded
+        self.fill(cursor, values)
+        return loaded
+
+    """Fills the table with values. Rows are replaced rather than inserted:
+       when the connection drops during the fill, the block is loaded again
+       (reload) before the failed statement is retried
+    """
+    def fill(self, cursor, values):
+        cursor.execute('create temporary table if not exists ' + self.name + \
+            ' (linenum int not null primary key, chrom varchar(32) not null,' + \
+            ' chrom_bare varchar(32) not null, pos int not null,' + \
+            ' key (chrom, pos), key (chrom_bare, pos));')
+        cursor.execute('delete from ' + self.name + ';')
+        if (len(values) > 0):
+            cursor.executemany('replace into ' + self.name + \
+                ' (linenum, chrom, chrom_bare, pos) values (%s, %s, %s, %s)',
+                values)
+
+    """Loads the current block again into the table of a new connection
+    """
+    def reload(self, cursor):
+        if getattr(self.state, 'records', None) is not None:
+            self.fill(cursor, self.state.values)
+
+
+"""Base class for the addOverlapWith* stages
+   var_count counts matching rows, line_count counts matching variants
+   When a VariantTable is given the stage runs in join mode: one query per
+   block instead of one query per variant. With sweep=True each block is
+   sorted by position and merged, per chromosome, with the table rows of
+   the block's range streamed in start order. With a reference bundle the
+   rows of a block are found with one vectorized search per chromosome.
+   Looking up the rows of a block (lookup) only reads the chromosome and
+   position of the records, applying them (applyFound) edits INFO. Lookups
+   of different overlap stages can therefore run concurrently as long as
+   the rows are applied in stage order.
+"""
+class OverlapStage(Stage):
+    # Table column holding the chromosome and the prefix it is stored with
+    chromColumn = 'chrom'
+    chromPrefix = 'chr'
+    # Interval columns, a variant overlaps a row if start <= pos <= end
+    startColumn = 'chromStart'
+    endColumn = 'chromEnd'
+    # Breaks the ties between rows with the same interval
+    nameColumn = 'name'
+    # False for tables only matched on an exact position
+    binQuery = True
+    # Only the first matching row is used
+    firstRow = False
+    # Columns of the bundle rows, None for all of them
+    bundleColumns = None
+    independent = True
+    counters = ['var_count', 'line_count']
+
+    def __init__(self, table, format='vcf', variants=None, sweep=False):
+        Stage.__init__(self, table=table, format=format)
+        self.variants = variants
+        self.sweep = sweep
+        self.block = None
+        self.var_count = 0
+        self.line_count = 0
+
+    def getChrom(self, record):
+        if (self.chromPrefix == ''):
+            return record.chrom_bare
+        return record.chrom
+
+    def getSql(self, chr, pos, bins=''):
+        return 'select * from ' + self.table + ' where ' + \
+            self.chromColumn + '="' + str(chr) + '" AND (chromStart <= ' + \
+            str(pos) + ' AND ' + str(pos) + ' <= chromEnd)' + bins + \
+            self.getOrderSql() + ';'
+
+    """Order of the rows overlapping a variant, by interval and then name
+       Every lookup mode reports the rows in this order, so the stages only
+       using the first row all pick the same one
+    """
+    def getOrderColumns(self):
+        return [self.startColumn, self.endColumn, self.nameColumn]
+
+    def getOrderSql(self):
+        return ' order by ' + ', '.join(self.getOrderColumns())
+
+    """Table queried for a chromosome
+    """
+    def getTable(self, chr):
+        return self.table
+
+    def getJoinCondition(self):
+        return 't.chromStart <= v.pos AND v.pos <= t.chromEnd'
+
+    def getJoinSql(self):
+        chrom = 'v.chrom' if self.chromPrefix else 'v.chrom_bare'
+        return 'select v.linenum, t.* from ' + self.variants.name + \
+            ' v join ' + self.table + ' t on t.' + self.chromColumn + \
+            ' = ' + chrom + ' AND ' + self.getJoinCondition() + \
+            ' order by v.linenum, ' + ', '.join(['t.' + column
+                for column in self.getOrderColumns()]) + ';'
+
+    def getRangeSql(self, chr, start, end):
+        return 'select ' + self.startColumn + ', ' + self.endColumn + \
+            ', ' + self.table + '.* from ' + self.table + ' where ' + \
+            self.chromColumn + '="' + str(chr) + '" AND ' + \
+            self.startColumn + ' <= ' + str(end) + ' AND ' + \
+            self.endColumn + ' >= ' + str(start) + self.getOrderSql() + ';'
+
+    def isAnnotated(self, chr):
+        return True
+
+    def getCacheKey(self, record):
+        return (self.getChrom(record), record.pos) + self.getLookupMode()
+
+    def getLookupMode(self):
+        return Stage.getLookupMode(self) + (self.variants is not None,
+            self.sweep)
+
+    def getFilterKey(self, record):
+        return (self.getChrom(record), record.pos)
+
+    """Same as Stage.lookupCached, remembering the whole block while its
+       records left by the prefilter and the cache are looked up
+    """
+    def lookupCached(self, cursor, records):
+        self.block = records
+        try:
+            return Stage.lookupCached(self, cursor, records)
+        finally:
+            self.block = None
+
+    def lookup(self, cursor, records):
+        if self.bundle is not None:
+            return self.lookupBundle(records)
+
+        if self.sweep:
+            return self.lookupSweep(cursor, records)
+
+        if self.variants is None:
+            return [self.lookupRecord(cursor, record) for record in records]
+
+        # The variant table holds the whole block, so it is loaded once per
+        # block whichever records of it each stage still has to look up
+        block = records if self.block is None else self.block
+        index = dict((id(record), i) for (i, record) in enumerate(records))
+        targets = [index.get(id(record)) for record in block]
+        if (len(block) - targets.count(None) < len(records)):
+            # Records not taken from the block, load them instead
+            (block, targets) = (records, list(range(len(records))))
+
+        found = [[] for record in records]
+        loaded = self.variants.load(cursor, block)
+
+        # Rows come back ordered by line, merge them with the records
+        cursor.execute(self.getJoinSql())
+        row = cursor.fetchone()
+        while row is not None:
+            if targets[row[0]] is not None:
+                found[targets[row[0]]].append(row[1:])
+            row = cursor.fetchone()
+
+        for (linenum, record) in enumerate(block):
+            if (targets[linenum] is not None) and not loaded[linenum]:
+                found[targets[linenum]] = self.lookupRecord(cursor, record)
+        return found
+
+    def lookupSweep(self, cursor, records):
+        found = [[] for record in records]
+        variants = {}
+        for (linenum, record) in enumerate(records):
+            pos = record.pos
+            if not pos.isdigit():
+                found[linenum] = self.lookupRecord(cursor, record)
+                continue
+            chr = self.getChrom(record)
+            if self.isAnnotated(chr):
+                variants.setdefault(chr, []).append((int(pos), linenum))
+
+        for (chr, chr_variants) in variants.items():
+            # Sorting is linear when the input is already coordinate sorted
+            chr_variants.sort(key=lambda v: v[0])
+            cursor.execute(self.getRangeSql(chr, chr_variants[0][0],
+                chr_variants[-1][0]))
+            self.sweepRows(cursor, chr_variants, found)
+        return found
+
+    """Merges the variants, sorted by position, with the rows of the range
+       query. Rows whose start was passed are kept in a heap ordered by end;
+       the rows left in the heap after dropping the ones that end before the
+       variant are exactly the rows overlapping it.
+    """
+    def sweepRows(self, cursor, variants, found):
+        active = []
+        seq = 0
+        row = cursor.fetchone()
+        for (pos, linenum) in variants:
+            while row is not None and row[0] <= pos:
+                heapq.heappush(active, (row[1], seq, row[2:]))
+                seq = seq + 1
+                row = cursor.fetchone()
+
+            while (len(active) > 0) and (active[0][0] < pos):
+                heapq.heappop(active)
+
+            # Report overlapping rows in arrival order, which is the row
+            # order of getOrderColumns
+            found[linenum] = [a[2] for a in sorted(active, key=lambda a: a[1])]
+
+    def lookupRecord(self, cursor, record):
+        chr = self.getChrom(record)
+        pos = record.pos
+        if not self.isAnnotated(chr):
+            return []
+        if self.bundle is not None:
+            return self.getBundleRows(chr, pos)
+
+        bins = ''
+        if self.binQuery and pos.isdigit():
+            bins = self.getBinSql(cursor, self.getTable(chr), int(pos),
+                int(pos))
+        cursor.execute(self.getSql(chr, pos, bins))
+        return self.fetchRows(cursor)
+
+    def applyFound(self, records, found):
+        for (record, rows) in zip(records, found):
+            self.addRows(record, rows)
+
+    """Bundle table holding the rows of a chromosome
+    """
+    def getBundleTable(self, chr):
+        return self.bundle.getTable(self.table)
+
+    def getBundleRows(self, chr, pos):
+        if not pos.isdigit():
+            return []
+        return self.getBundleTable(chr).overlap(chr, int(pos), int(pos),
+            columns=self.bundleColumns)
+
+    """Looks up a block in the bundle with one vectorized search per
+       chromosome (see bundle.BundleTable.overlapPositions)
+    """
+    def lookupBundle(self, records):
+        found = [[] for record in records]
+        variants = {}
+        for (linenum, record) in enumerate(records):
+            chr = self.getChrom(record)
+            if record.pos.isdigit() and self.isAnnotated(chr):
+                (linenums, positions) = variants.setdefault(chr, ([], []))
+                linenums.append(linenum)
+                positions.append(int(record.pos))
+
+        for (chr, (linenums, positions)) in variants.items():
+            rows = self.getBundleTable(chr).overlapPositions(chr, positions,
+                columns=self.bundleColumns, first=self.firstRow)
+            for (linenum, r) in zip(linenums, rows):
+                found[linenum] = r
+        return found
+
+    def fetchRows(self, cursor):
+        return cursor.fetchall()
+
+    def addRows(self, record, rows):
+        if (len(rows) > 0):
+            self.line_count = self.line_count + 1
+            self.var_count = self.var_count + len(rows)
+            self.applyRows(record, rows)
+
+    def applyRows(self, record, rows):
+        raise NotImplementedError
+
+    def appendInfo(self, record, info):
+        if record.isInfoTerminated():
+            record.extendInfo(info)
+        else:
+            record.appendInfo(info)
+
+    def logLines(self):
+        return [f"In {str(self.table)}: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n"]
+
+
+"""Overlap stages that only look at the first matching row (fetchone)
+"""
+class FirstOverlapStage(OverlapStage):
+    firstRow = True
+
+    def fetchRows(self, cursor):
+        row = cursor.fetchone()
+        return [] if row is None else [row]
+
+    def addRows(self, record, rows):
+        OverlapStage.addRows(self, record, rows[:1])
+
+    def applyRows(self, record, rows):
+        self.applyRow(record, rows[0])
+
+    def applyRow(self, record, row):
+        raise NotImplementedError
+
+
+"""Overlap with Cytoband table, see annotate.addOverlapWithCytoband
+"""
+class CytobandStage(OverlapStage):
+    name = 'Cytoband'
+
+    def __init__(self, format='vcf', table='cytoBand', variants=None,
+        sweep=False):
+        OverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def applyRows(self, record, rows):
+        overlapsWith = u.dedup([str(row[3]) for row in rows])
+        self.appendInfo(record, str(self.table) + '=' + ';'.join(overlapsWith))
+
+
+"""Overlap with GadAll table, see annotate.addOverlapWithGadAll
+"""
+class GadAllStage(OverlapStage):
+    name = 'gadAll'
+    chromColumn = 'chromosome'
+    nameColumn = 'geneSymbol'
+    chromPrefix = ''
+
+    def __init__(self, format='vcf', table='gadAll', variants=None,
+        sweep=False):
+        OverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def applyRows(self, record, rows):
+        r_tmp = []
+        records = []
+        for row in rows:
+            if not fu.isOnTheList(r_tmp, str(row[3])):
+                r_tmp.append(str(row[3]))
+                records.append(str(self.table) + '=' + str(row[3]))
+        self.appendInfo(record, ';'.join(records))
+        # annotate.addOverlapWithGadAll writes annotated lines joined
+        # with '\t ', keep the same output
+        record.prefixFields(' ')
+
+
+"""Overlap with gwasCatalog table, see annotate.addOverlapWithGwasCatalog
+"""
+class GwasCatalogStage(OverlapStage):
+    name = 'GwasCatalog'
+    startColumn = 'chromEnd'
+    binQuery = False
+
+    def __init__(self, format='vcf', table='gwasCatalog', variants=None,
+        sweep=False):
+        OverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def getSql(self, chr, pos, bins=''):
+        return 'select * from ' + self.table + ' where chrom="' + \
+            str(chr) + '" AND chromEnd = ' + str(pos) + \
+            self.getOrderSql() + ';'
+
+    def getJoinCondition(self):
+        return 't.chromEnd = v.pos'
+
+    def applyRows(self, record, rows):
+        records = []
+        for row in rows:
+            records.append(str(self.table) + '=' + str('pubMedID') + \
+                '=' + str(row[5]) + ',trait=' + str(row[10]))
+        self.appendInfo(record, ';'.join(records))
+
+
+"""Overlap with targetScanS table, see annotate.addOverlapWithMiRNA
+"""
+class MiRNAStage(FirstOverlapStage):
+    name = 'miRNA'
+
+    def __init__(self, format='vcf', table='targetScanS', variants=None,
+        sweep=False):
+        FirstOverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def applyRow(self, record, row):
+        t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+            str(row[2]) + '_' + str(row[3])
+        self.appendInfo(record, 'miRNAsites=' + t.strip())
+
+    def logLines(self):
+        return [f"In miRNAsites: {str(self.var_count)} in " + \
+            f"{str(self.line_count)} variants\n"]
+
+
+"""Overlap with HGNC table, see annotate.addOverlapWitHUGOGeneNomenclature
+"""
+class HugoStage(OverlapStage):
+    name = 'HUGO Gene Nomenclature Committee'
+
+    def __init__(self, format='vcf', table='hugo', variants=None,
+        sweep=False):
+        OverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def applyRows(self, record, rows):
+        r_tmp = []
+        records = []
+        for row in rows:
+            t = str(str(row[5]) + ',' + str(row[6])).strip()
+            if not fu.isOnTheList(r_tmp, t):
+                r_tmp.append(t)
+                records.append('HGNC_GeneAnnotation' + '=' + t)
+        self.appendInfo(record, ','.join(records).replace(';', ','))
+
+
+"""Overlap with CNV tables, see annotate.addOverlapWithCnvDatabase
+   Only whether a row covers the variant matters, so with coverage maps
+   of the table (see cnvcoverage.py) no row is read at all
+"""
+class CnvStage(FirstOverlapStage):
+
+    def __init__(self, format='vcf', table='dgv_Cnv', variants=None,
+        sweep=False):
+        FirstOverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+        self.name = table
+
+    def hasCoverage(self):
+        return (self.coverage is not None) and \
+            self.coverage.hasTable(self.table)
+
+    def getLookupMode(self):
+        # The coverage maps return a placeholder instead of the first row
+        return FirstOverlapStage.getLookupMode(self) + (self.hasCoverage(),)
+
+    def lookup(self, cursor, records):
+        if not self.hasCoverage():
+            return FirstOverlapStage.lookup(self, cursor, records)
+
+        found = [[] for record in records]
+        variants = {}
+        for (linenum, record) in enumerate(records):
+            if not record.pos.isdigit():
+                found[linenum] = self.lookupRecord(cursor, record)
+                continue
+            (linenums, positions) = variants.setdefault(
+                self.getChrom(record), ([], []))
+            linenums.append(linenum)
+            positions.append(int(record.pos))
+
+        for (chr, (linenums, positions)) in variants.items():
+            covered = self.coverage.covers(self.table, chr, positions)
+            for (linenum, c) in zip(linenums, covered):
+                if c:
+                    # Stands for the first row, applyRow only needs one
+                    found[linenum] = [(self.table,)]
+        return found
+
+    def applyRow(self, record, row):
+        self.appendInfo(record, str(self.table) + '=' + str(True))
+
+
+"""Overlap with segdup regions, see annotate.addOverlapWithGenomicSuperDups
+"""
+class GenomicSuperDupsStage(FirstOverlapStage):
+    name = 'genomicSuperDups'
+
+    def __init__(self, format='vcf', table='genomicSuperDups', variants=None,
+        sweep=False):
+        FirstOverlapStage.__init__(self, table=table, format=format,
+            variants=variants, sweep=sweep)
+
+    def applyRow(self, record, row):
+        record.appendInfo(str(self.table) + '=' + \
+            str(True) + ';' + 'otherChrom=' + str(row[7]) + \
+            ';otherStart=' + str(row[8]) + ';otherEnd=' + str(row[9]))
+
+
+"""Overlap with tfbsConsSites, see annotate.addOverlapWithTfbsConsSites
+   The sites are split into one table per chromosome
+"""
+class TfbsConsSitesStage(OverlapStage):
+    name = 'tfbsConsSites'
+    bundleColumns = ['chrom', 'chromStart', 'chromEnd', 'name']
+    allowed_chrom = ['1','2','3','4','5','6','7','8','9','10','11','12','13',
+        '14','15','16','17','18','19','20','21','22','X','Y']
+
+    def __init__(self, format='vcf', table='tfbsConsSites', sweep=False):
+        OverlapStage.__init__(self, table=table, format=format, sweep=sweep)
+
+    def isAnnotated(self, chr):
+        return (chr.replace('chr', '') in self.allowed_chrom)
+
+    def getTable(self, chr):
+        return 'tfbsConsSites' + chr.replace('chr', '')
+
+    def getSql(self, chr, pos, bins=''):
+        return 'select chrom, chromStart, chromEnd, name ' + \
+            'from tfbsConsSites' + chr.replace('chr', '') + \
+            ' where  chromStart <= ' + str(pos) + ' AND ' + \
+            str(pos) + ' <= chromEnd' + bins + self.getOrderSql() + ';'
+
+    def getBundleTable(self, chr):
+        return self.bundle.getTable('tfbsConsSites' + chr.replace('chr', ''))
+
+    def getRangeSql(self, chr, start, end):
+        return 'select chromStart, chromEnd, chrom, chromStart, chromEnd, ' + \
+            'name from tfbsConsSites' + chr.replace('chr', '') + \
+            ' where chromStart <= ' + str(end) + ' AND chromEnd >= ' + \
+            str(start) + self.getOrderSql() + ';'
+
+    def applyRows(self, record, rows):
+        records = []
+        for row in rows:
+            t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                str(row[1]) + '.' + str(row[2])
+            records.append('tfbsRegion' + '=' + t.strip())
+        self.appendInfo(record, ';'.join(records))
+
+
+"""Default stage list, in the same order as the original driver
+   join=True annotates the overlap tables with one JOIN per block against
+   a session temporary table instead of one query per variant; sweep=True
+   merges each block with one range query per table and chromosome.
+   With a reference bundle all lookups are answered from the bundle.
+   bins=True adds UCSC bin predicates to the per-variant range queries
+"""
+def defaultStages(format='vcf', join=False, sweep=False, bundle=None,
+    bins=False):
+    variants = VariantTable() if join else None
+    overlap = {'format': format, 'variants': variants, 'sweep': sweep}
+    stages = [DbSnpStage(format=format, batchsize=BATCH_SIZE),
+        BigRefGeneStage(format=format, batchsize=UNION_SIZE),
+        GenesStage(format=format, table='refGene', promoter_offset=500),
+        CytobandStage(table='cytoBand', **overlap),
+        GadAllStage(table='gadAll', **overlap),
+        GwasCatalogStage(table='gwasCatalog', **overlap),
+        MiRNAStage(table='targetScanS', **overlap),
+        HugoStage(table='hugo', **overlap),
+        CnvStage(table='dgv_Cnv', **overlap),
+        CnvStage(table='abParts_IG_T_CelReceptors', **overlap),
+        CnvStage(table='mcCarroll_Cnv', **overlap),
+        CnvStage(table='conrad_Cnv', **overlap),
+        GenomicSuperDupsStage(table='genomicSuperDups', **overlap),
+        TfbsConsSitesStage(format=format, table='tfbsConsSites',
+            sweep=sweep)]
+    for stage in stages:
+        stage.bundle = bundle
+        stage.bins = bins
+    return stages
+
+### EOF
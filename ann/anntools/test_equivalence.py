@@ -0,0 +1,266 @@
+# test_equivalence.py
+#
+# Copyright (C) 2011-2019 Vas Vasiliadis
+# University of Chicago
+#
+# Output equivalence of the annotation modes
+#
+# Annotates a generated VCF against an SQLite stand-in of the reference
+# database (see localdb.py) with the original chain of annotate.py stages,
+# then with every mode of the single-pass engine, and checks that each
+# mode writes the same .annot.vcf and .count.log.
+#
+# Usage:
+#   python -m pytest -q test_equivalence.py
+#
+##
+__author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
+
+import os
+import io
+import gzip
+import shutil
+import tempfile
+import unittest
+
+# Variants of the generated input, and records per engine block (several
+# blocks per chromosome)
+VARIANTS = 400
+BLOCK_SIZE = 64
+
+
+"""In-memory stand-in of the S3 client calls made by checkpoint.py
+   Deletes are ignored, so the last checkpoint of a completed run is left
+   for the next run to resume from
+"""
+class CheckpointClient(object):
+
+    class exceptions(object):
+        class NoSuchKey(Exception):
+            pass
+
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.exceptions.NoSuchKey(Key)
+        return {'Body': io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def upload_file(self, path, bucket, key):
+        with open(path, 'rb') as fh:
+            self.objects[(bucket, key)] = fh.read()
+
+    def download_file(self, bucket, key, path):
+        with open(path, 'wb') as fh:
+            fh.write(self.objects[(bucket, key)])
+
+    def delete_objects(self, Bucket, Delete):
+        pass
+
+
+"""Lines of the .count.log file without the cache and prefilter counters,
+   which only some modes add
+"""
+def readCountLog(filename):
+    with open(filename) as fh:
+        lines = fh.readlines()
+    for header in ('Annotation cache:\n', 'Prefilter:\n'):
+        if header in lines:
+            lines = lines[:lines.index(header)]
+    return lines
+
+
+def readAnnotated(filename):
+    if filename.endswith('.gz'):
+        with gzip.open(filename, 'rt') as fh:
+            return fh.readlines()
+    with open(filename) as fh:
+        return fh.readlines()
+
+
+"""Adds rows overlapping the first variant to tables of stages that only
+   use the first matching row: rows with the same start, the one to report
+   inserted last, so that a lookup not ordering the rows picks another one
+"""
+def addOverlappingRows(db, vcf):
+    import sqlite3
+    import localdb
+    import binning
+
+    (chrom, pos, ref, alt) = localdb.readVariants([vcf])[0]
+    chrom = 'chr' + chrom
+    bin = binning.binFromRange(0, pos + 1)
+    conn = sqlite3.connect(db)
+    # Ends differ
+    localdb.insert(conn, 'genomicSuperDups', [
+        (bin, chrom, 0, pos + 1, 'dup', 0, '+', 'chr2', 200, 300),
+        (bin, chrom, 0, pos, 'dup', 0, '+', 'chr1', 100, 200)])
+    # Only names differ
+    localdb.insert(conn, 'targetScanS', [
+        (bin, chrom, 0, pos, 'miR-2', 1, '+'),
+        (bin, chrom, 0, pos, 'miR-1', 1, '+')])
+    conn.commit()
+    conn.close()
+
+
+class EquivalenceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp(prefix='anntools_test_')
+        cls.db = os.path.join(cls.dir, 'reference.db')
+        cls.vcf = os.path.join(cls.dir, 'input.vcf')
+        cls.environ = os.environ.get('ANNTOOLS_SQLITE_DB')
+        os.environ['ANNTOOLS_SQLITE_DB'] = cls.db
+
+        import benchmark
+        import localdb
+        import driver
+        import engine
+        benchmark.generateVcf(cls.vcf, VARIANTS)
+        localdb.generate(cls.db, [cls.vcf])
+        addOverlappingRows(cls.db, cls.vcf)
+
+        infile = cls.copyInput('staged')
+        driver.run(infile, 'vcf', fused=False)
+        cls.expected = readAnnotated(engine.getAnnotatedFileName(infile))
+        cls.expected_log = readCountLog(infile + '.count.log')
+
+    @classmethod
+    def tearDownClass(cls):
+        import utils as u
+        u.close_db_connection()
+        if cls.environ is None:
+            del os.environ['ANNTOOLS_SQLITE_DB']
+        else:
+            os.environ['ANNTOOLS_SQLITE_DB'] = cls.environ
+        shutil.rmtree(cls.dir)
+
+    """Copy of the input in a directory of its own, named after mode
+    """
+    @classmethod
+    def copyInput(cls, mode):
+        path = os.path.join(cls.dir, mode)
+        os.makedirs(path)
+        infile = os.path.join(path, 'input.vcf')
+        shutil.copy(cls.vcf, infile)
+        return infile
+
+    """Annotates a copy of the input with the engine options of a mode and
+       compares its output with the one of the staged pipeline
+       With sharded=True the options are passed to driver.run instead
+       Returns the stages run by the engine, None with sharded=True
+    """
+    def checkMode(self, mode, sharded=False, **options):
+        import driver
+        import engine
+
+        infile = self.copyInput(mode)
+        stages = None
+        if sharded:
+            driver.run(infile, 'vcf', blocksize=BLOCK_SIZE, **options)
+        else:
+            stages = engine.run(infile, format='vcf', blocksize=BLOCK_SIZE,
+                **options)
+
+        annotated = readAnnotated(engine.getAnnotatedFileName(infile,
+            compress=options.get('compress', False)))
+        self.assertEqual(self.expected, annotated, mode)
+        self.assertEqual(self.expected_log,
+            readCountLog(infile + '.count.log'), mode)
+        return stages
+
+    """The staged run reports the rows addOverlappingRows inserted last
+    """
+    def testFirstRow(self):
+        line = [l for l in self.expected if not l.startswith('#')][0]
+        self.assertIn('otherChrom=chr1;', line)
+        self.assertIn('miRNAsites=miR-1,', line)
+
+    def testFused(self):
+        self.checkMode('fused')
+
+    def testJoin(self):
+        self.checkMode('join', join=True)
+
+    def testThreads(self):
+        self.checkMode('threads', threads=3)
+
+    def testJoinThreads(self):
+        self.checkMode('join_threads', join=True, threads=3)
+
+    def testBins(self):
+        self.checkMode('bins', bins=True)
+
+    def testShards(self):
+        self.checkMode('shards', sharded=True, processes=2)
+
+    def testCache(self):
+        cache = os.path.join(self.dir, 'reference.cache')
+        self.checkMode('cache_cold', cache=cache, cache_version='test')
+        stages = self.checkMode('cache_warm', cache=cache,
+            cache_version='test')
+        # The warm run finds every lookup of the cached stages in the cache
+        for stage in stages:
+            if stage.name in ('dbSNP', 'BigRefGene', 'Genes', 'Cytoband'):
+                self.assertGreater(stage.cache_hits, 0, stage.name)
+                self.assertEqual(stage.cache_misses, 0, stage.name)
+        stages = self.checkMode('cache_join_threads', cache=cache,
+            cache_version='test', join=True, threads=3)
+        # The rows found in another lookup mode are not reused
+        for stage in stages:
+            if (stage.name == 'Cytoband'):
+                self.assertEqual(0, stage.cache_hits)
+        # Without a reference version the cache is not used
+        stages = self.checkMode('cache_unversioned', cache=cache)
+        self.assertEqual(0, sum([stage.cache_hits + stage.cache_misses
+            for stage in stages]))
+
+    def testPrefilter(self):
+        import prefilter
+        path = os.path.join(self.dir, 'reference.prefilter')
+        prefilter.build(path)
+        self.checkMode('prefilter', prefilter=path)
+        self.checkMode('prefilter_join', prefilter=path, join=True)
+
+    def testCoverage(self):
+        import cnvcoverage
+        path = os.path.join(self.dir, 'reference.coverage')
+        cnvcoverage.build(path)
+        self.checkMode('coverage', coverage=path)
+        self.checkMode('coverage_join', coverage=path, join=True)
+
+    def testCompress(self):
+        self.checkMode('compress', compress=True)
+
+    def testCheckpoint(self):
+        import checkpoint
+        client = CheckpointClient()
+        url = 's3://bucket/checkpoints/job'
+        self.checkMode('checkpoint', checkpoint=checkpoint.Checkpoint(url,
+            interval=0, client=client))
+        # Resumes from the last checkpoint left by the first run
+        self.assertIn(('bucket', 'checkpoints/job/' + checkpoint.MANIFEST),
+            client.objects)
+        self.checkMode('checkpoint_resume',
+            checkpoint=checkpoint.Checkpoint(url, interval=0, client=client))
+
+    def testSweep(self):
+        self.checkMode('sweep', sweep=True)
+
+    def testBundle(self):
+        import bundle
+        path = os.path.join(self.dir, 'reference.bundle')
+        bundle.export(path)
+        self.checkMode('bundle', bundle=path)
+        self.checkMode('bundle_threads', bundle=path, threads=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+### EOF
@@ -13,24 +13,56 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+# Seconds the RDS credentials from Secrets Manager are cached for
+SECRET_TTL = 900
+# MySQL errors of a connection that was dropped: server has gone away,
+# lost connection during query. Statements failing with them are retried
+RETRY_ERRORS = (2006, 2013)
+
+_secret = {'value': None, 'expires': 0}
+_secret_lock = threading.Lock()
+_connections = threading.local()
+
+
+"""Get RDS credentials, cached for SECRET_TTL seconds so a job does not
+   call Secrets Manager for every stage
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
-
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+def get_rds_secret(refresh=False):
+    with _secret_lock:
+        if refresh or (_secret['value'] is None) or \
+            (time.time() >= _secret['expires']):
+            AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+                ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+            # Get RDS secret from AWS Secrets Manager
+            asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+            try:
+                asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
+                _secret['value'] = json.loads(asm_response['SecretString'])
+                _secret['expires'] = time.time() + SECRET_TTL
+            except ClientError as e:
+                print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+                raise e
+
+        return _secret['value']
+
+
+"""Get a new connection to reference database
+   With ANNTOOLS_SQLITE_DB set, a connection to that SQLite stand-in of
+   the reference tables (see localdb.py), e.g. for benchmarks
+"""
+def db_connect(refresh=False):
+    if os.environ.get('ANNTOOLS_SQLITE_DB'):
+        import localdb
+        return localdb.connect(os.environ['ANNTOOLS_SQLITE_DB'])
+
+    rds_secret = get_rds_secret(refresh=refresh)
 
     # Extract database connection parameters
     rds_host = rds_secret['host']
@@ -48,6 +80,91 @@ def db_connect():
         db=database_name)
 
 
+"""Get the shared connection to reference database
+   Connections are reused by all stages of a process (one per thread, as
+   pymysql connections are not thread safe). The connection is pinged
+   every time it is checked out (once per block in the engine); if it is
+   gone a new one is opened, with fresh credentials in case they were
+   rotated. Callers must not close the returned connection.
+"""
+def get_db_connection():
+    conn = getattr(_connections, 'conn', None)
+
+    if conn is not None:
+        try:
+            conn.ping(reconnect=False)
+        except pymysql.err.Error:
+            close_db_connection()
+            conn = None
+
+    if conn is None:
+        try:
+            conn = db_connect()
+        except pymysql.err.OperationalError:
+            conn = db_connect(refresh=True)
+        _connections.conn = conn
+
+    return conn
+
+
+"""Close the shared connection of the calling thread, if any
+"""
+def close_db_connection():
+    conn = getattr(_connections, 'conn', None)
+    _connections.conn = None
+    if conn is not None:
+        try:
+            conn.close()
+        except pymysql.err.Error:
+            pass
+
+
+"""Drops the shared connection of the calling thread without closing it,
+   in a process forked while it was open: closing it would also end the
+   session of the parent process, which uses the same socket
+"""
+def forget_db_connection():
+    _connections.conn = None
+
+
+"""Cursor of the shared connection that survives the connection being
+   dropped while a block is annotated (RDS failover, server timeout...)
+   A statement failing with one of RETRY_ERRORS is run once more on a new
+   connection, after the callbacks registered with onReconnect restored
+   the session state (temporary tables) on it
+"""
+class RetryCursor(object):
+
+    def __init__(self):
+        self.cursor = get_db_connection().cursor()
+        self.callbacks = []
+
+    def onReconnect(self, callback):
+        if callback not in self.callbacks:
+            self.callbacks.append(callback)
+
+    def execute(self, sql, args=None):
+        return self.run('execute', sql, args)
+
+    def executemany(self, sql, args):
+        return self.run('executemany', sql, args)
+
+    def run(self, method, sql, args):
+        try:
+            return getattr(self.cursor, method)(sql, args)
+        except pymysql.err.OperationalError as e:
+            if (len(e.args) == 0) or (e.args[0] not in RETRY_ERRORS):
+                raise
+        close_db_connection()
+        self.cursor = get_db_connection().cursor()
+        for callback in self.callbacks:
+            callback(self)
+        return getattr(self.cursor, method)(sql, args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
@@ -109,13 +226,15 @@ def dedup(mylist):
 
 
 """Helper method to parse fields
+   Returns the value of the first field whose name contains key, up to
+   any further sep2, or '.' if there is none
 """
 def parse_field(text, key, sep1, sep2):
-    fields = text.strip().split(sep1)
-    for f in fields:
-        pairs = f.split(sep2)
-        if (str(pairs[0]).find(str(key)) > -1):
-            return str(pairs[1])
+    key = str(key)
+    for f in text.strip().split(sep1):
+        pairs = f.split(sep2, 2)
+        if key in pairs[0]:
+            return pairs[1]
     return '.'
 
 ### EOF
\ No newline at end of file